@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import time
+from django.core.cache import cache
+
+from pretix_taler.utils import config_int
+
+logger = logging.getLogger(__name__)
+
+
+def capabilities_cache_key(merchant_api_url):
+    h = hashlib.sha1(merchant_api_url.encode()).hexdigest()
+    return f"pretix_taler:capabilities:{h}"
+
+
+def fetch_capabilities(merchant_api_url, background=False, **kwargs):
+    """
+    Asks a merchant backend for its configuration with ``GET config`` and stores the
+    result in the cache shared by all processes.
+    """
+    from pretix_taler.client import MerchantClient
+
+    r = MerchantClient(merchant_api_url, background=background).get("config", **kwargs)
+    r.raise_for_status()
+    resp = r.json()
+    previous = cache.get(capabilities_cache_key(merchant_api_url)) or {}
+    capabilities = {
+        "name": resp.get("name"),
+        "currency": resp.get("currency"),
+        "version": resp.get("version"),
+        # Features observed at runtime are not part of the configuration
+        "features": previous.get("features", {}),
+        "fetched_at": time.time(),
+    }
+    cache.set(capabilities_cache_key(merchant_api_url), capabilities, 30 * 24 * 3600)
+    return capabilities
+
+
+def refresh_capabilities_async(merchant_api_url):
+    from pretix_taler.tasks import refresh_capabilities
+
+    if cache.add(f"{capabilities_cache_key(merchant_api_url)}:refresh", "1", 300):
+        refresh_capabilities.apply_async(args=(merchant_api_url,))
+
+
+def get_capabilities(merchant_api_url, fetch=True):
+    """
+    Returns the capabilities of a merchant backend from the cache. Entries older than
+    ``capabilities_ttl`` are still returned, but refreshed in the background. If
+    nothing is cached yet, the backend is asked right away if ``fetch`` is set,
+    otherwise ``None`` is returned and the backend is asked in the background.
+    """
+    capabilities = cache.get(capabilities_cache_key(merchant_api_url))
+    if capabilities is None:
+        if fetch:
+            return fetch_capabilities(merchant_api_url)
+        refresh_capabilities_async(merchant_api_url)
+        return None
+    if time.time() - capabilities["fetched_at"] > config_int("capabilities_ttl", 3600):
+        refresh_capabilities_async(merchant_api_url)
+    return capabilities
+
+
+def supports(merchant_api_url, feature):
+    """
+    Returns whether a merchant backend supports a feature, without contacting it.
+    Features are assumed to be supported until the backend showed otherwise.
+    """
+    capabilities = get_capabilities(merchant_api_url, fetch=False)
+    return capabilities is None or capabilities.get("features", {}).get(feature, True)
+
+
+def set_supported(merchant_api_url, feature, supported):
+    """
+    Records whether a merchant backend supports a feature, as observed at runtime.
+    """
+    key = capabilities_cache_key(merchant_api_url)
+    capabilities = cache.get(key)
+    if capabilities is None:
+        return
+    capabilities.setdefault("features", {})[feature] = supported
+    cache.set(key, capabilities, 30 * 24 * 3600)
@@ -0,0 +1,144 @@
+import requests
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin
+
+from pretix_taler.health import BackendHealth
+from pretix_taler.metrics import observe_merchant_request
+from pretix_taler.ratelimit import RateLimiter
+from pretix_taler.utils import config_float, config_int
+
+
+class MerchantUnavailable(requests.ConnectionError):
+    """
+    Raised instead of sending a request to a merchant backend whose circuit is open.
+    """
+
+
+class MerchantRateLimited(MerchantUnavailable):
+    """
+    Raised if no request to a merchant backend could be sent within the rate limit.
+    """
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(merchant_api_url):
+    """
+    Returns a shared session for the given merchant backend. Every backend gets its
+    own connection pool, so connections are kept alive across requests and threads.
+    """
+    with _sessions_lock:
+        session = _sessions.get(merchant_api_url)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=config_int("pool_size", 10),
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[merchant_api_url] = session
+        return session
+
+
+def default_timeout():
+    return (
+        config_float("connect_timeout", 5),
+        config_float("read_timeout", 30),
+    )
+
+
+class MerchantClient:
+    def __init__(self, merchant_api_url, merchant_api_key=None, background=False):
+        self.merchant_api_url = merchant_api_url
+        self.merchant_api_key = merchant_api_key
+        # Background requests (polling, refunds) yield to interactive ones when the
+        # backend's rate limit is reached
+        self.background = background
+
+    @property
+    def health(self):
+        return BackendHealth(self.merchant_api_url)
+
+    def request(self, method, path, timeout=None, bypass_circuit=False, **kwargs):
+        health = self.health
+        longpoll = "timeout_ms" in (kwargs.get("params") or {})
+        circuit = "closed" if bypass_circuit else health.circuit
+        # Once the cooldown passed, one request at a time checks whether the backend
+        # is back
+        trial = circuit == "half-open" and health.start_trial()
+        if circuit == "open" or (circuit == "half-open" and not trial):
+            observe_merchant_request(
+                self.merchant_api_url, method, path, "unavailable", 0
+            )
+            raise MerchantUnavailable(
+                f"Merchant backend {self.merchant_api_url} is currently unavailable."
+            )
+        try:
+            return self._send(
+                method, path, health, timeout, bypass_circuit, longpoll, **kwargs
+            )
+        finally:
+            if trial:
+                health.end_trial()
+
+    def _send(self, method, path, health, timeout, bypass_circuit, longpoll, **kwargs):
+        if not bypass_circuit and not RateLimiter(self.merchant_api_url).acquire(
+            self.background, config_float("rate_limit_wait", 5)
+        ):
+            observe_merchant_request(
+                self.merchant_api_url, method, path, "rate_limited", 0
+            )
+            raise MerchantRateLimited(
+                f"Rate limit for merchant backend {self.merchant_api_url} exceeded."
+            )
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if self.merchant_api_key:
+            headers["Authorization"] = f"Bearer secret-token:{self.merchant_api_key}"
+        start = time.monotonic()
+        try:
+            r = get_session(self.merchant_api_url).request(
+                method,
+                urljoin(self.merchant_api_url, path),
+                headers=headers,
+                timeout=timeout or default_timeout(),
+                **kwargs,
+            )
+        except requests.RequestException as e:
+            duration = time.monotonic() - start
+            health.record_failure(duration)
+            observe_merchant_request(
+                self.merchant_api_url,
+                method,
+                path,
+                "timeout" if isinstance(e, requests.Timeout) else "error",
+                duration,
+                longpoll=longpoll,
+            )
+            raise
+        duration = time.monotonic() - start
+        if r.status_code >= 500:
+            health.record_failure(duration)
+        elif not longpoll:
+            # Long polling requests say nothing about the latency of the backend
+            health.record_success(duration)
+        observe_merchant_request(
+            self.merchant_api_url,
+            method,
+            path,
+            r.status_code,
+            duration,
+            longpoll=longpoll,
+        )
+        return r
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
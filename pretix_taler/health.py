@@ -0,0 +1,122 @@
+import hashlib
+import logging
+import time
+from django.core.cache import cache
+
+from pretix_taler.utils import config_float, config_int
+
+logger = logging.getLogger(__name__)
+
+
+class BackendHealth:
+    """
+    Tracks error rates and latency of a merchant backend across all processes through
+    Django's cache and implements a circuit breaker on top of it.
+
+    After ``circuit_failures`` consecutive failures, the circuit opens and requests to
+    the backend fail immediately. Once ``circuit_cooldown`` seconds have passed, the
+    circuit is half-open: one request at a time is let through as a trial, and closes
+    the circuit again if the backend responds or opens it for another cooldown if not.
+    The periodic task additionally probes such backends with ``GET config``.
+    """
+
+    # Weight of the latest request in the latency and error rate averages
+    SMOOTHING = 0.2
+
+    def __init__(self, merchant_api_url):
+        self.merchant_api_url = merchant_api_url
+        h = hashlib.sha1(merchant_api_url.encode()).hexdigest()
+        self.cache_key = f"pretix_taler:health:{h}"
+
+    @property
+    def state(self):
+        return cache.get(self.cache_key) or {
+            "failures": 0,
+            "open_until": None,
+            "latency": None,
+            "error_rate": 0.0,
+        }
+
+    def _save(self, state):
+        cache.set(self.cache_key, state, 7 * 24 * 3600)
+
+    def _record(self, success, latency):
+        state = self.state
+        if state["latency"] is None:
+            state["latency"] = latency
+        else:
+            state["latency"] += self.SMOOTHING * (latency - state["latency"])
+        state["error_rate"] += self.SMOOTHING * (
+            (0.0 if success else 1.0) - state["error_rate"]
+        )
+        return state
+
+    def record_success(self, latency):
+        state = self._record(True, latency)
+        if state["open_until"] is not None:
+            logger.info("Taler merchant backend %s is back up", self.merchant_api_url)
+        state["failures"] = 0
+        state["open_until"] = None
+        self._save(state)
+
+    def record_failure(self, latency):
+        state = self._record(False, latency)
+        state["failures"] += 1
+        if state["failures"] >= config_int("circuit_failures", 5) and (
+            state["open_until"] is None or state["open_until"] <= time.time()
+        ):
+            if state["open_until"] is None:
+                logger.warning(
+                    "Taler merchant backend %s failed %d times in a row, pausing "
+                    "requests",
+                    self.merchant_api_url,
+                    state["failures"],
+                )
+            # Opens the circuit, or opens it again after a failed trial
+            state["open_until"] = time.time() + config_float("circuit_cooldown", 60)
+        self._save(state)
+
+    @property
+    def circuit(self):
+        open_until = self.state["open_until"]
+        if open_until is None:
+            return "closed"
+        if open_until > time.time():
+            return "open"
+        return "half-open"
+
+    @property
+    def is_open(self):
+        return self.circuit != "closed"
+
+    @property
+    def is_available(self):
+        return self.circuit != "open"
+
+    def start_trial(self):
+        """
+        Returns whether the caller may send the trial request of a half-open circuit.
+        Callers that get ``True`` need to call ``end_trial()`` afterwards.
+        """
+        return cache.add(f"{self.cache_key}:trial", "1", 60)
+
+    def end_trial(self):
+        cache.delete(f"{self.cache_key}:trial")
+
+    def probe(self):
+        """
+        Checks a backend with an open circuit once its cooldown has passed. Only one
+        process probes a backend at a time.
+        """
+        from pretix_taler.capabilities import fetch_capabilities
+
+        if self.circuit != "half-open" or not self.start_trial():
+            return
+        try:
+            fetch_capabilities(self.merchant_api_url, bypass_circuit=True)
+        except Exception:
+            state = self.state
+            state["open_until"] = time.time() + config_float("circuit_cooldown", 60)
+            self._save(state)
+        finally:
+            self.end_trial()
@@ -0,0 +1,94 @@
+"""
+Instrumentation of merchant API requests and poll runs. Values are exported through
+pretix' own metrics endpoint if ``METRICS_ENABLED`` is set, and additionally sent as
+Django signals so they can be fed into other monitoring systems.
+"""
+
+import re
+from django.dispatch import Signal
+from pretix.base.metrics import Counter, Gauge, Histogram
+
+merchant_request_finished = Signal()
+"""
+Sent after every request to a merchant backend. Receivers get the keyword arguments
+``merchant_api_url``, ``method``, ``endpoint`` (the path with order IDs replaced by a
+placeholder), ``status`` (the HTTP status code, ``"timeout"``, ``"error"`` or
+``"unavailable"`` if the circuit was open or ``"rate_limited"``) and ``duration`` in seconds.
+"""
+
+poll_cycle_finished = Signal()
+"""
+Sent after every run of the periodic poll task. Receivers get the keyword arguments
+``due`` (rows due at the start of the run), ``processed``, ``confirmed``, ``expired``
+and ``duration`` in seconds.
+"""
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+taler_merchant_requests_total = Counter(
+    name="taler_merchant_requests_total",
+    helpstring="Number of requests sent to Taler merchant backends",
+    labelnames=["backend", "endpoint", "status"],
+)
+taler_merchant_request_duration_seconds = Histogram(
+    name="taler_merchant_request_duration_seconds",
+    helpstring="Duration of requests to Taler merchant backends, without long polling",
+    labelnames=["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+taler_poll_rows_due = Gauge(
+    name="taler_poll_rows_due",
+    helpstring="Number of Taler orders due for polling at the start of the last run",
+)
+taler_poll_rows_total = Counter(
+    name="taler_poll_rows_total",
+    helpstring="Number of Taler orders handled by the periodic task",
+    labelnames=["result"],
+)
+taler_poll_duration_seconds = Histogram(
+    name="taler_poll_duration_seconds",
+    helpstring="Duration of runs of the periodic Taler poll task",
+    buckets=(1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, float("inf")),
+)
+
+_order_path = re.compile(r"^private/orders/[^/]+")
+
+
+def endpoint_name(path):
+    return _order_path.sub("private/orders/{order_id}", path)
+
+
+def observe_merchant_request(
+    merchant_api_url, method, path, status, duration, longpoll=False
+):
+    endpoint = endpoint_name(path)
+    taler_merchant_requests_total.inc(
+        backend=merchant_api_url, endpoint=endpoint, status=str(status)
+    )
+    if not longpoll and status not in ("unavailable", "rate_limited"):
+        # The duration of a long polling request is mostly waiting time
+        taler_merchant_request_duration_seconds.observe(duration, endpoint=endpoint)
+    merchant_request_finished.send(
+        sender=None,
+        merchant_api_url=merchant_api_url,
+        method=method,
+        endpoint=endpoint,
+        status=status,
+        duration=duration,
+    )
+
+
+def observe_poll_cycle(due, processed, confirmed, expired, duration):
+    taler_poll_rows_due.set(due)
+    taler_poll_rows_total.inc(processed, result="processed")
+    taler_poll_rows_total.inc(confirmed, result="confirmed")
+    taler_poll_rows_total.inc(expired, result="expired")
+    taler_poll_duration_seconds.observe(duration)
+    poll_cycle_finished.send(
+        sender=None,
+        due=due,
+        processed=processed,
+        confirmed=confirmed,
+        expired=expired,
+        duration=duration,
+    )
@@ -0,0 +1,53 @@
+import json
+from datetime import datetime, timedelta, timezone
+from django.db import migrations, models
+from django.utils.timezone import now
+
+
+def fix_poll_schedule(apps, schema_editor):
+    TalerOrder = apps.get_model("pretix_taler", "TalerOrder")
+
+    # Up to now, poll_until was computed as a relative offset of a unix timestamp,
+    # which placed it decades into the future. Recompute it from the deadlines.
+    for t in TalerOrder.objects.select_related("payment").iterator():
+        try:
+            info = json.loads(t.payment.info or "{}")
+        except ValueError:
+            info = {}
+        deadlines = [
+            info[k]["t_s"]
+            for k in ("pay_deadline", "refund_deadline")
+            if isinstance(info.get(k), dict) and isinstance(info[k].get("t_s"), int)
+        ]
+        if deadlines:
+            t.poll_until = datetime.fromtimestamp(
+                max(deadlines) + 3600, tz=timezone.utc
+            )
+        else:
+            t.poll_until = t.payment.created + timedelta(hours=2)
+        t.next_poll_at = now() if t.poll_until > now() else None
+        t.save(update_fields=["poll_until", "next_poll_at"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_taler", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="talerorder",
+            name="next_poll_at",
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="talerorder",
+            name="last_polled_at",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(
+            fix_poll_schedule,
+            migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_taler", "0002_talerorder_schedule"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="talerorder",
+            name="refunds_processed",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
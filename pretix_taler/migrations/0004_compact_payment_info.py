@@ -0,0 +1,58 @@
+import json
+from django.db import migrations
+
+PAYMENT_INFO_KEYS = (
+    "order_id",
+    "token",
+    "taler_pay_uri",
+    "amount",
+    "summary",
+    "pay_deadline",
+    "refund_deadline",
+    "order_status",
+    "refunded",
+    "preparing",
+    "error",
+    "message",
+)
+
+
+def compact_payment_info(apps, schema_editor):
+    OrderPayment = apps.get_model("pretixbase", "OrderPayment")
+
+    batch = []
+    for p in (
+        OrderPayment.objects.filter(provider__startswith="taler")
+        .exclude(info__isnull=True)
+        .only("pk", "info")
+        .iterator()
+    ):
+        try:
+            info = json.loads(p.info)
+        except ValueError:
+            continue
+        if not isinstance(info, dict):
+            continue
+        compact = {k: v for k, v in info.items() if k in PAYMENT_INFO_KEYS}
+        if compact != info:
+            p.info = json.dumps(compact, sort_keys=True)
+            batch.append(p)
+        if len(batch) >= 500:
+            OrderPayment.objects.bulk_update(batch, ["info"])
+            batch = []
+    if batch:
+        OrderPayment.objects.bulk_update(batch, ["info"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_taler", "0003_talerorder_refunds_processed"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            compact_payment_info,
+            migrations.RunPython.noop,
+        ),
+    ]
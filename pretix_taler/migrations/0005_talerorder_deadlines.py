@@ -0,0 +1,62 @@
+import json
+from datetime import datetime, timezone
+from django.db import migrations, models
+
+
+def backfill(apps, schema_editor):
+    TalerOrder = apps.get_model("pretix_taler", "TalerOrder")
+
+    def deadline(info, key):
+        if isinstance(info.get(key), dict) and isinstance(info[key].get("t_s"), int):
+            return datetime.fromtimestamp(info[key]["t_s"], tz=timezone.utc)
+
+    batch = []
+    for t in TalerOrder.objects.select_related("payment").iterator():
+        try:
+            info = json.loads(t.payment.info or "{}")
+        except ValueError:
+            continue
+        if not isinstance(info, dict):
+            continue
+        t.order_id = info.get("order_id")
+        t.pay_deadline = deadline(info, "pay_deadline")
+        t.refund_deadline = deadline(info, "refund_deadline")
+        batch.append(t)
+        if len(batch) >= 500:
+            TalerOrder.objects.bulk_update(
+                batch, ["order_id", "pay_deadline", "refund_deadline"]
+            )
+            batch = []
+    if batch:
+        TalerOrder.objects.bulk_update(
+            batch, ["order_id", "pay_deadline", "refund_deadline"]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_taler", "0004_compact_payment_info"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="talerorder",
+            name="order_id",
+            field=models.CharField(db_index=True, max_length=190, null=True),
+        ),
+        migrations.AddField(
+            model_name="talerorder",
+            name="pay_deadline",
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="talerorder",
+            name="refund_deadline",
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.RunPython(
+            backfill,
+            migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_taler", "0005_talerorder_deadlines"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="talerorder",
+            name="watched_until",
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
@@ -1,6 +1,79 @@
+from datetime import timedelta
 from django.db import models
+from django.utils.timezone import now
+
+# Bounds for the interval between two polls of the same merchant order. The interval
+# grows with the age of the payment, so fresh payments are checked often while
+# abandoned ones quickly fall back to the maximum.
+POLL_INTERVAL_MIN = timedelta(seconds=30)
+POLL_INTERVAL_MAX_PENDING = timedelta(minutes=15)
+POLL_INTERVAL_MAX_CONFIRMED = timedelta(hours=6)
+POLL_BACKOFF_FACTOR = 0.25
+# If the merchant backend notifies us through webhooks, polling is only a safety net
+POLL_INTERVAL_MIN_PUSH = timedelta(minutes=30)
+# How long a payment counts as watched after the last sign of life of its payment page
+WATCH_DURATION = timedelta(seconds=30)
 
 
 class TalerOrder(models.Model):
     payment = models.ForeignKey("pretixbase.OrderPayment", on_delete=models.CASCADE)
     poll_until = models.DateTimeField()
+    next_poll_at = models.DateTimeField(null=True, db_index=True)
+    # Time of the last successful status check with the merchant backend
+    last_polled_at = models.DateTimeField(null=True)
+    # Copies of the merchant order ID and deadlines from the payment info, so they can
+    # be queried without decoding the payment info
+    order_id = models.CharField(max_length=190, null=True, db_index=True)
+    pay_deadline = models.DateTimeField(null=True, db_index=True)
+    refund_deadline = models.DateTimeField(null=True, db_index=True)
+    # Number of entries at the start of the merchant's refund list that are processed
+    refunds_processed = models.PositiveIntegerField(default=0)
+    # Set while a customer has the payment page open, such payments are polled in a
+    # separate fast lane
+    watched_until = models.DateTimeField(null=True, db_index=True)
+
+    def retire(self):
+        self.next_poll_at = None
+
+    def schedule_next_poll(self, push=False):
+        """
+        Computes ``next_poll_at`` based on the current state and age of the payment.
+        Payments that can no longer change in a way we care about are retired.
+
+        ``push`` signals that the merchant backend sends webhooks for this payment.
+        """
+        from pretix.base.models import OrderPayment
+
+        payment = self.payment
+        n = now()
+        if n >= self.poll_until:
+            self.retire()
+            return
+
+        if payment.state in (
+            OrderPayment.PAYMENT_STATE_CREATED,
+            OrderPayment.PAYMENT_STATE_PENDING,
+        ):
+            cap = POLL_INTERVAL_MAX_PENDING
+            deadline = self.pay_deadline
+        elif payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED:
+            cap = POLL_INTERVAL_MAX_CONFIRMED
+            deadline = self.refund_deadline
+            if deadline and deadline < n:
+                # Refunds are no longer possible, nothing left to observe
+                self.retire()
+                return
+        else:
+            self.retire()
+            return
+
+        interval = min(
+            max((n - payment.created) * POLL_BACKOFF_FACTOR, POLL_INTERVAL_MIN), cap
+        )
+        if push:
+            interval = max(interval, POLL_INTERVAL_MIN_PUSH)
+        next_poll_at = min(n + interval, self.poll_until)
+        if deadline and deadline > n:
+            # Make sure we look at the order again right after the deadline passed
+            next_poll_at = min(next_poll_at, deadline + timedelta(seconds=1))
+        self.next_poll_at = next_poll_at
@@ -1,36 +1,129 @@
 import hashlib
 import json
 import logging
+import random
 import requests
 import time
 from collections import OrderedDict
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 from django import forms
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
+from django.db import transaction
 from django.http import HttpRequest
 from django.template.loader import get_template
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 from pretix.base.forms import SecretKeySettingsField
-from pretix.base.models import Event, OrderPayment, OrderRefund
+from pretix.base.models import Event, OrderPayment, OrderRefund, Quota
 from pretix.base.payment import BasePaymentProvider, PaymentException
 from pretix.base.settings import SettingsSandbox
 from pretix.multidomain.urlreverse import build_absolute_uri, eventreverse
-from urllib.parse import urljoin
 
+from pretix_taler.capabilities import fetch_capabilities, get_capabilities
+from pretix_taler.client import MerchantClient, MerchantUnavailable, default_timeout
 from pretix_taler.models import TalerOrder
+from pretix_taler.status import cached_order_status, invalidate_order_status
+from pretix_taler.utils import config_bool, config_float, config_int
 
 logger = logging.getLogger(__name__)
 
 
+# Keys of merchant responses that are stored with the payment. Everything else is only
+# kept if store_full_responses is enabled.
+PAYMENT_INFO_KEYS = (
+    "order_id",
+    "token",
+    "taler_pay_uri",
+    "amount",
+    "summary",
+    "pay_deadline",
+    "refund_deadline",
+    "order_status",
+    "refunded",
+    "preparing",
+    "error",
+    "message",
+)
+
+
+def payment_info(data):
+    if config_bool("store_full_responses", False):
+        return data
+    return {k: v for k, v in data.items() if k in PAYMENT_INFO_KEYS}
+
+
+def fetch_order_status(client, order_id, timeout_ms=None, use_cache=True):
+    """
+    Retrieves the status of a merchant order. This does not touch the database and is
+    therefore safe to call from worker threads.
+
+    If ``timeout_ms`` is given, the merchant backend holds the request until the order
+    is paid or the timeout passed. Long polling always bypasses the status cache.
+    """
+
+    def fetch():
+        if timeout_ms:
+            connect_timeout, read_timeout = default_timeout()
+            r = client.get(
+                f"private/orders/{order_id}",
+                params={"timeout_ms": timeout_ms},
+                timeout=(connect_timeout, read_timeout + timeout_ms / 1000),
+            )
+        else:
+            r = client.get(f"private/orders/{order_id}")
+        r.raise_for_status()
+        return r.json()
+
+    return cached_order_status(
+        client.merchant_api_url,
+        order_id,
+        fetch,
+        use_cache=use_cache and not timeout_ms,
+    )
+
+
+def list_orders(client, page_size=100, start=None, descending=False, **filters):
+    """
+    Iterates over the merchant's order list, which can be filtered e.g. by ``paid``,
+    ``refunded`` or ``date_s``. Results are fetched in pages of ascending row IDs
+    starting after the row ID ``start``, or descending ones starting before it.
+    """
+    if start is None:
+        start = 2**63 - 1 if descending else 0
+    delta = -page_size if descending else page_size
+    while True:
+        r = client.get(
+            "private/orders",
+            params={**filters, "delta": delta, "start": start},
+        )
+        r.raise_for_status()
+        orders = r.json()["orders"]
+        yield from orders
+        if len(orders) < page_size:
+            break
+        start = orders[-1]["row_id"]
+
+
 class Taler(BasePaymentProvider):
     identifier = "taler"
     verbose_name = _("Taler")
     public_name = _("Taler")
     abort_pending_allowed = True
 
+    @property
+    def merchant_client(self):
+        return self.get_merchant_client()
+
+    def get_merchant_client(self, background=False):
+        return MerchantClient(
+            self.settings.merchant_api_url,
+            self.settings.merchant_api_key,
+            background=background,
+        )
+
     @property
     def settings_form_fields(self):
         fields = [
@@ -53,6 +146,24 @@ class Taler(BasePaymentProvider):
                     label=_("Merchant API key"),
                 ),
             ),
+            (
+                "webhook_secret",
+                SecretKeySettingsField(
+                    label=_("Webhook secret"),
+                    help_text=_(
+                        'Optional. If set, configure webhooks for the events "pay" and "refund" in your '
+                        "merchant backend that send a POST request to {url} with the header "
+                        '"Authorization: Bearer <secret>" and the body '
+                        '{{"order_id": "{{{{order_id}}}}"}}. Payments will then be confirmed right away '
+                        "and the merchant backend is polled much less frequently."
+                    ).format(
+                        url=build_absolute_uri(
+                            self.event, "plugins:pretix_taler:webhook"
+                        )
+                    ),
+                    required=False,
+                ),
+            ),
             (
                 "max_pay_deadline",
                 forms.IntegerField(
@@ -78,6 +189,28 @@ class Taler(BasePaymentProvider):
                     initial=60 * 24 * 7,
                 ),
             ),
+            (
+                "async_order_creation",
+                forms.BooleanField(
+                    label=_("Create Taler orders in the background"),
+                    help_text=_(
+                        "Customers are sent to the payment page right away while the order is created in the "
+                        "merchant backend. This keeps checkout fast if your merchant backend is slow."
+                    ),
+                    required=False,
+                ),
+            ),
+            (
+                "refund_queue",
+                forms.BooleanField(
+                    label=_("Submit refunds in the background"),
+                    help_text=_(
+                        "Refunds are collected and submitted to the merchant backend in bulk. This is "
+                        "recommended if you need to refund many orders at once, e.g. when cancelling an event."
+                    ),
+                    required=False,
+                ),
+            ),
             (
                 "testmode_kudos",
                 forms.BooleanField(
@@ -93,41 +226,19 @@ class Taler(BasePaymentProvider):
 
     def settings_form_clean(self, cleaned_data):
         cleaned_data = super().settings_form_clean(cleaned_data)
-        if not cleaned_data.get("payment_taler_merchant_api_url"):
+        url = cleaned_data.get("payment_taler_merchant_api_url")
+        if not url:
             return cleaned_data
 
         try:
-            r = requests.get(
-                urljoin(
-                    cleaned_data.get("payment_taler_merchant_api_url"),
-                    "config",
-                ),
-            )
-            r.raise_for_status()
-            resp = r.json()
-            if resp["name"] != "taler-merchant":
-                raise ValidationError(
-                    _(
-                        "We were unable to contact the Taler merchant backend for validation. "
-                        "Received error: {error}"
-                    ).format(error="API does not seem to be a Taler merchant backend")
-                )
-            if resp["currency"] != self.event.currency and not (resp["currency"] == "KUDOS" and cleaned_data.get("payment_taler_testmode_kudos") and self.event.testmode):
-                raise ValidationError(
-                    _(
-                        "This Taler merchant backend only supports payments in {taler_currency} but your event uses {event_currency}."
-                    ).format(taler_currency=resp["currency"], event_currency=self.event.currency)
-                )
-
-            protocol_version = 3
-            version_current, version_revision, version_age = [int(v) for v in resp["version"].split(":")]
-            if version_current < protocol_version or version_revision - version_age > protocol_version:
-                raise ValidationError(
-                    _(
-                        "This Taler merchant backend only supports protocol versions {lower} to {upper}, but we require version {expected}."
-                    ).format(lower=version_current - version_age, upper=version_current, expected=protocol_version)
-                )
-
+            # A backend that has been validated before is not contacted again
+            # until its cached capabilities expire
+            try:
+                self._check_capabilities(get_capabilities(url), cleaned_data)
+            except ValidationError:
+                # The cached configuration might be outdated, e.g. if the backend was
+                # fixed since
+                self._check_capabilities(fetch_capabilities(url), cleaned_data)
         except requests.RequestException as e:
             logger.exception("Failed to contact Taler merchant backend")
             raise ValidationError(
@@ -138,6 +249,52 @@ class Taler(BasePaymentProvider):
             )
         return cleaned_data
 
+    def is_allowed(self, request: HttpRequest, total: Decimal = None) -> bool:
+        return super().is_allowed(request, total) and (
+            not self.settings.merchant_api_url
+            or self.merchant_client.health.is_available
+        )
+
+    def _check_capabilities(self, resp, cleaned_data):
+        if resp["name"] != "taler-merchant":
+            raise ValidationError(
+                _(
+                    "We were unable to contact the Taler merchant backend for validation. "
+                    "Received error: {error}"
+                ).format(error="API does not seem to be a Taler merchant backend")
+            )
+        if resp["currency"] != self.event.currency and not (
+            resp["currency"] == "KUDOS"
+            and cleaned_data.get("payment_taler_testmode_kudos")
+            and self.event.testmode
+        ):
+            raise ValidationError(
+                _(
+                    "This Taler merchant backend only supports payments in {taler_currency} but your event uses {event_currency}."
+                ).format(
+                    taler_currency=resp["currency"],
+                    event_currency=self.event.currency,
+                )
+            )
+
+        protocol_version = 3
+        version_current, version_revision, version_age = [
+            int(v) for v in resp["version"].split(":")
+        ]
+        if (
+            version_current < protocol_version
+            or version_revision - version_age > protocol_version
+        ):
+            raise ValidationError(
+                _(
+                    "This Taler merchant backend only supports protocol versions {lower} to {upper}, but we require version {expected}."
+                ).format(
+                    lower=version_current - version_age,
+                    upper=version_current,
+                    expected=protocol_version,
+                )
+            )
+
     def checkout_prepare(self, request: HttpRequest, cart):
         return self.payment_prepare(request, None)
 
@@ -153,6 +310,15 @@ class Taler(BasePaymentProvider):
                 "Taler is operating in test mode and will charge you in KUDOS instead of the correct currency."
             )
 
+    def settings_content_render(self, request) -> str:
+        from pretix_taler.refunds import progress_key
+
+        progress = cache.get(progress_key(self.event))
+        if not progress:
+            return ""
+        template = get_template("pretix_taler/refund_progress.html")
+        return template.render({"request": request, "progress": progress})
+
     def payment_control_render(self, request, payment) -> str:
         if payment.info:
             payment_info = payment.info_data
@@ -198,10 +364,48 @@ class Taler(BasePaymentProvider):
             "settings": self.settings,
             "payment": payment,
             "taler_url": payment.info_data.get("taler_pay_uri"),
+            "preparing": payment.info_data.get("preparing"),
+            "return_url": self._return_url(payment),
+            "qr_url": self._payment_url(payment, "qr"),
         }
         return template.render(ctx)
 
+    def _return_url(self, payment):
+        return self._payment_url(payment, "return")
+
+    def _payment_url(self, payment, url_name):
+        return eventreverse(
+            self.event,
+            f"plugins:pretix_taler:{url_name}",
+            kwargs={
+                "order": payment.order.code,
+                "payment": payment.pk,
+                "hash": hashlib.sha1(payment.order.secret.lower().encode()).hexdigest(),
+            },
+        )
+
     def execute_payment(self, request: HttpRequest, payment: OrderPayment) -> str:
+        if self.settings.get("async_order_creation", as_type=bool, default=False):
+            from pretix_taler.tasks import create_merchant_order
+
+            payment.info_data = {"preparing": True}
+            payment.state = OrderPayment.PAYMENT_STATE_PENDING
+            payment.save(update_fields=["info", "state"])
+            # Lets the periodic task pick up the payment in case the background task
+            # gets lost
+            t = TalerOrder(payment=payment, poll_until=now() + timedelta(hours=2))
+            t.schedule_next_poll()
+            t.save()
+            transaction.on_commit(
+                lambda: create_merchant_order.apply_async(
+                    kwargs={"event": self.event.pk, "payment": payment.pk}
+                )
+            )
+        else:
+            self._create_merchant_order(payment)
+        return self._return_url(payment)
+
+    def _create_merchant_order(self, payment: OrderPayment):
         currency = (
             "KUDOS"
             if self.settings.testmode_kudos and payment.order.testmode
@@ -251,21 +455,13 @@ class Taler(BasePaymentProvider):
             "create_token": True,
         }
         try:
-            r = requests.post(
-                urljoin(
-                    self.settings.merchant_api_url,
-                    f"private/orders",
-                ),
-                json=payload,
-                headers={
-                    "Authorization": f"Bearer secret-token:{self.settings.merchant_api_key}"
-                },
-            )
+            client = self.merchant_client
+            resp, error = self._submit_merchant_order(client, payload)
 
-            if r.status_code not in (200, 201):
+            if error is not None:
                 payment.info_data = {
                     "error": True,
-                    "message": r.text,
+                    "message": error,
                 }
                 payment.state = OrderPayment.PAYMENT_STATE_FAILED
                 payment.save()
@@ -274,7 +470,7 @@ class Taler(BasePaymentProvider):
                     {
                         "local_id": payment.local_id,
                         "provider": payment.provider,
-                        "message": r.text,
+                        "message": error,
                     },
                 )
                 raise PaymentException(
@@ -283,46 +479,34 @@ class Taler(BasePaymentProvider):
                     )
                 )
 
-            resp = r.json()
-            payment.info_data = resp
+            order_resp = fetch_order_status(client, resp["order_id"], use_cache=False)
 
-            r = requests.get(
-                urljoin(
-                    self.settings.merchant_api_url,
-                    f"private/orders/{payment.info_data['order_id']}",
-                ),
-                headers={
-                    "Authorization": f"Bearer secret-token:{self.settings.merchant_api_key}"
-                },
+            payment.info_data = payment_info(
+                {
+                    **payload["order"],
+                    **resp,
+                    **order_resp,
+                }
             )
-            r.raise_for_status()
-            order_resp = r.json()
-
-            payment.info_data = {
-                **payload["order"],
-                **payment.info_data,
-                **order_resp,
-            }
             payment.state = OrderPayment.PAYMENT_STATE_PENDING
             payment.save(update_fields=["info", "state"])
-            TalerOrder.objects.create(
-                payment=payment,
-                poll_until=now()
-                + timedelta(
-                    seconds=max(pay_deadline_unixtime, refund_deadline_unixtime) + 3600
-                ),
+            t = TalerOrder.objects.filter(payment=payment).first() or TalerOrder(
+                payment=payment
             )
-            return eventreverse(
-                self.event,
-                "plugins:pretix_taler:return",
-                kwargs={
-                    "order": payment.order.code,
-                    "payment": payment.pk,
-                    "hash": hashlib.sha1(
-                        payment.order.secret.lower().encode()
-                    ).hexdigest(),
-                },
+            t.payment = payment
+            t.order_id = resp["order_id"]
+            t.pay_deadline = datetime.fromtimestamp(
+                int(pay_deadline_unixtime), tz=timezone.utc
             )
+            t.refund_deadline = datetime.fromtimestamp(
+                int(refund_deadline_unixtime), tz=timezone.utc
+            )
+            t.poll_until = datetime.fromtimestamp(
+                max(pay_deadline_unixtime, refund_deadline_unixtime) + 3600,
+                tz=timezone.utc,
+            )
+            t.schedule_next_poll(push=bool(self.settings.webhook_secret))
+            t.save()
         except requests.RequestException as e:
             logger.exception("Failed to contact Taler merchant backend")
             payment.info_data = {
@@ -346,64 +530,107 @@ class Taler(BasePaymentProvider):
                 )
             )
 
-    def _query_and_process(self, payment):
+    def _submit_merchant_order(self, client, payload):
+        """
+        Creates the merchant order and retries failures that happen before the
+        merchant processed the request (connection errors, 5xx, 429) with jittered
+        backoff, within a total deadline of ``order_create_deadline`` seconds.
+
+        The order ID is derived from the payment and every attempt sends the same
+        payload, so retries never create a second order: the merchant answers a replay
+        with the existing order. If it reports a conflict instead, or does not answer
+        in time, we continue with the existing order as long as it is for the same
+        amount.
+
+        Returns the merchant's response and ``None``, or ``None`` and an error
+        message if the order could not be created.
+        """
+        attempts = max(1, config_int("order_create_attempts", 3))
+        give_up = time.monotonic() + config_float("order_create_deadline", 15)
+        error = None
+        for attempt in range(attempts):
+            if attempt:
+                wait = 0.25 * 2**attempt * random.uniform(0.5, 1.5)
+                if time.monotonic() + wait > give_up:
+                    break
+                time.sleep(wait)
+            try:
+                r = client.post("private/orders", json=payload)
+            except MerchantUnavailable:
+                raise
+            except requests.ConnectionError as e:
+                # Includes connect timeouts, but not read timeouts: if the merchant
+                # did not answer in time, another attempt would most likely take just
+                # as long and keep the customer waiting
+                error = e
+                continue
+            except requests.Timeout as e:
+                # The merchant might have created the order without answering in time
+                try:
+                    existing = self._existing_order(client, payload)
+                except requests.RequestException:
+                    raise e
+                if existing:
+                    return existing, None
+                raise
+
+            if r.status_code in (200, 201):
+                return r.json(), None
+            if r.status_code == 409:
+                existing = self._existing_order(client, payload)
+                if existing:
+                    return existing, None
+                return None, r.text
+            if r.status_code >= 500 or r.status_code == 429:
+                error = r.text
+                continue
+            return None, r.text
+
+        if isinstance(error, Exception):
+            raise error
+        return None, error
+
+    def _existing_order(self, client, payload):
+        """
+        Looks up the merchant order with the ID of ``payload`` and returns it if it
+        is for the same amount, otherwise ``None``. Raises ``HTTPError`` if the order
+        does not exist.
+        """
+        order_id = payload["order"]["order_id"]
+        existing = fetch_order_status(client, order_id, use_cache=False)
+        amount = existing.get("total_amount") or (
+            existing.get("contract_terms") or {}
+        ).get("amount")
+        if amount and amount != payload["order"]["amount"]:
+            return None
+        logger.info("Recovered existing Taler merchant order %s", order_id)
+        return {"order_id": order_id}
+
+    def _query_and_process(
+        self, payment, timeout_ms=None, use_cache=True, taler_order=None
+    ):
+        if payment.info_data.get("preparing"):
+            # The merchant order is still being created in the background
+            return
         if "order_id" not in payment.info_data:
             payment.fail(log_data={"reason": "No order_id"})
             raise PaymentException("Invalid state")
         try:
-            r = requests.get(
-                urljoin(
-                    self.settings.merchant_api_url,
-                    f"private/orders/{payment.info_data['order_id']}",
-                ),
-                headers={
-                    "Authorization": f"Bearer secret-token:{self.settings.merchant_api_key}"
-                },
+            resp = fetch_order_status(
+                self.merchant_client,
+                payment.info_data["order_id"],
+                timeout_ms=timeout_ms,
+                use_cache=use_cache,
             )
-            r.raise_for_status()
-            resp = r.json()
-
-            if (
-                resp["order_status"] == "paid"
-                and not resp.get("refunded")
-                and payment.state
-                not in (
-                    OrderPayment.PAYMENT_STATE_REFUNDED,
-                    OrderPayment.PAYMENT_STATE_CONFIRMED,
-                )
-            ):
-                payment.info_data = {**payment.info_data, **resp}
-                payment.confirm()
-
-            if resp.get("refund_details"):
-                pending_refunds = list(
-                    payment.refunds.filter(state=OrderRefund.REFUND_STATE_TRANSIT)
-                )
-                external_refunds = list(
-                    payment.refunds.filter(source=OrderRefund.REFUND_SOURCE_EXTERNAL)
-                )
-                for api_refund in resp["refund_details"]:
-                    for r in pending_refunds:
-                        # Check for refunds that we started and that are now done
-                        if (
-                            api_refund["reason"].startswith(f"{r.full_id} ")
-                            and not api_refund["pending"]
-                        ):
-                            r.done()
-                            break
-                    else:
-                        # Check for refunds that we did not started and that we should know about
-                        if not api_refund["pending"] and not any(
-                            r.info_data["timestamp"] == api_refund["timestamp"]
-                            for r in external_refunds
-                        ):
-                            payment.create_external_refund(
-                                amount=Decimal(api_refund["amount"].split(":")[1]),
-                                info=json.dumps(api_refund),
-                            )
-
         except requests.RequestException as e:
-            logger.exception("Failed to contact Taler merchant backend")
+            self._poll_failed(payment, e)
+        self._process_order_status(payment, resp, taler_order)
+
+    def _poll_failed(self, payment, e):
+        if not isinstance(e, MerchantUnavailable):
+            # While the circuit is open, there is no point in logging the same
+            # failure on thousands of orders
+            logger.exception("Failed to contact Taler merchant backend", exc_info=e)
             payment.order.log_action(
                 "pretix_taler.poll_failed",
                 {
@@ -412,41 +639,140 @@ class Taler(BasePaymentProvider):
                     "message": str(e),
                 },
             )
-            raise PaymentException(
-                _(
-                    "We were unable to contact the payment system. Please try again later."
-                )
+        raise PaymentException(
+            _("We were unable to contact the payment system. Please try again later.")
+        )
+
+    def _process_order_status(self, payment, resp, taler_order=None, bulk=False):
+        """
+        Updates the payment and its refunds to the order status reported by the
+        merchant backend. With ``bulk``, changes to ``taler_order`` are left for the
+        caller to save.
+        """
+        if (
+            resp["order_status"] == "paid"
+            and not resp.get("refunded")
+            and payment.state
+            not in (
+                OrderPayment.PAYMENT_STATE_REFUNDED,
+                OrderPayment.PAYMENT_STATE_CONFIRMED,
             )
+        ):
+            payment.info_data = payment_info({**payment.info_data, **resp})
+            try:
+                payment.confirm()
+            except Quota.QuotaExceededException:
+                # The payment is confirmed, but the order expired in the meantime and
+                # its quota is gone. pretix marks the order for manual review.
+                pass
+
+        refund_details = resp.get("refund_details") or []
+        if not refund_details:
+            return
+        if taler_order is None:
+            taler_order = TalerOrder.objects.filter(payment=payment).first()
+
+        # All refund entries before the watermark have been fully processed before,
+        # the merchant backend only ever appends to this list.
+        watermark = taler_order.refunds_processed if taler_order else 0
+        if watermark >= len(refund_details):
+            return
+
+        refunds = list(payment.refunds.all())
+        own_refunds = {
+            r.full_id: r
+            for r in refunds
+            if r.source != OrderRefund.REFUND_SOURCE_EXTERNAL
+        }
+        external_refund_timestamps = {
+            json.dumps(r.info_data.get("timestamp"), sort_keys=True)
+            for r in refunds
+            if r.source == OrderRefund.REFUND_SOURCE_EXTERNAL
+        }
+        new_watermark = None
+        for i, api_refund in enumerate(refund_details[watermark:], start=watermark):
+            if api_refund["pending"]:
+                if new_watermark is None:
+                    new_watermark = i
+                continue
+
+            # Refunds that we started carry our refund ID at the start of the reason
+            r = own_refunds.get(api_refund["reason"].split(" ", 1)[0])
+            if r and r.state in (
+                OrderRefund.REFUND_STATE_FAILED,
+                OrderRefund.REFUND_STATE_CANCELED,
+            ):
+                # We gave up on this refund, e.g. after a timeout, but the merchant
+                # processed it anyway. The money is gone, so it is recorded like a
+                # refund we did not start.
+                pass
+            elif r:
+                if r.state == OrderRefund.REFUND_STATE_TRANSIT:
+                    r.done()
+                continue
+
+            # Check for refunds that we did not started and that we should know about
+            timestamp = json.dumps(api_refund["timestamp"], sort_keys=True)
+            if timestamp not in external_refund_timestamps:
+                payment.create_external_refund(
+                    amount=Decimal(api_refund["amount"].split(":")[1]),
+                    info=json.dumps(api_refund),
+                )
+                external_refund_timestamps.add(timestamp)
+
+        if new_watermark is None:
+            new_watermark = len(refund_details)
+        if taler_order and new_watermark != taler_order.refunds_processed:
+            taler_order.refunds_processed = new_watermark
+            if not bulk:
+                taler_order.save(update_fields=["refunds_processed"])
 
     def payment_refund_supported(self, payment: OrderPayment) -> bool:
-        return (
-            "refund_deadline" in payment.info_data
-            and payment.info_data["refund_deadline"]["t_s"] > time.time() + 180
+        t = TalerOrder.objects.filter(payment=payment).only("refund_deadline").first()
+        return bool(
+            t
+            and t.refund_deadline
+            and t.refund_deadline > now() + timedelta(seconds=180)
         )
 
     def payment_partial_refund_supported(self, payment: OrderPayment) -> bool:
         return self.payment_refund_supported(payment)
 
-    def execute_refund(self, refund: OrderRefund):
+    def _refund_request(self, refund: OrderRefund):
         currency = (
             "KUDOS"
             if self.settings.testmode_kudos and refund.order.testmode
             else self.event.currency
         )
+        return (
+            f"private/orders/{refund.payment.info_data['order_id']}/refund",
+            {
+                "refund": f"{currency}:{refund.amount}",
+                "reason": f"{refund.full_id} {refund.comment or str(_('Refund'))}",
+            },
+        )
+
+    def execute_refund(self, refund: OrderRefund):
+        if self.settings.get("refund_queue", as_type=bool, default=False):
+            from pretix_taler.refunds import queue_scheduled_key
+            from pretix_taler.tasks import process_refund_queue
+
+            # The refund is submitted in bulk with other refunds of the event, e.g. if
+            # the event is cancelled
+            refund.info_data = {"queued": True}
+            refund.state = OrderRefund.REFUND_STATE_TRANSIT
+            refund.save(update_fields=["info", "state"])
+            if cache.add(queue_scheduled_key(self.event), "1", 60):
+                transaction.on_commit(
+                    lambda: process_refund_queue.apply_async(
+                        kwargs={"event": self.event.pk}, countdown=5
+                    )
+                )
+            return
+
+        path, payload = self._refund_request(refund)
         try:
-            r = requests.post(
-                urljoin(
-                    self.settings.merchant_api_url,
-                    f"private/orders/{refund.payment.info_data['order_id']}/refund",
-                ),
-                json={
-                    "refund": f"{currency}:{refund.amount}",
-                    "reason": f"{refund.full_id} {refund.comment or str(_('Refund'))}",
-                },
-                headers={
-                    "Authorization": f"Bearer secret-token:{self.settings.merchant_api_key}"
-                },
-            )
+            r = self.merchant_client.post(path, json=payload)
 
             if r.status_code not in (200, 201):
                 raise PaymentException(
@@ -457,6 +783,9 @@ class Taler(BasePaymentProvider):
 
             resp = r.json()
 
+            invalidate_order_status(
+                self.settings.merchant_api_url, refund.payment.info_data["order_id"]
+            )
             refund.info_data = resp
             refund.state = OrderRefund.REFUND_STATE_TRANSIT
             refund.save(update_fields=["info", "state"])
@@ -0,0 +1,554 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Min, Q
+from django.db.models.functions import Mod
+from django.utils.timezone import now
+from pretix.base.models import OrderPayment
+from pretix.base.payment import PaymentException
+
+from pretix_taler.client import default_timeout
+from pretix_taler.health import BackendHealth
+from pretix_taler.metrics import observe_poll_cycle
+from pretix_taler.models import WATCH_DURATION, TalerOrder
+from pretix_taler.payment import fetch_order_status, list_orders
+from pretix_taler.utils import config_bool, config_float, config_int, config_str
+
+logger = logging.getLogger(__name__)
+
+
+class EventContext:
+    """
+    The payment provider and its resolved settings for one event. Within a run of the
+    periodic task, all payments of an event share one instance.
+    """
+
+    def __init__(self, payment):
+        self.provider = payment.payment_provider
+        # Settings are resolved here, on the main thread, so the worker threads never
+        # need to access the database.
+        self.client = self.provider.get_merchant_client(background=True)
+        self.push = bool(self.provider.settings.webhook_secret)
+
+
+def event_context(contexts, payment):
+    event_id = payment.order.event_id
+    if event_id not in contexts:
+        contexts[event_id] = EventContext(payment)
+    return contexts[event_id]
+
+
+class PollJob:
+    def __init__(self, taler_order, context):
+        self.taler_order = taler_order
+        self.payment = taler_order.payment
+        self.provider = context.provider
+        self.client = context.client
+        self.push = context.push
+        self.order_id = taler_order.order_id
+        self.response = None
+        self.error = None
+        # Set if a batch reconciliation showed that the merchant order did not change,
+        # so no detail request is necessary
+        self.unchanged = False
+        self.confirmed = False
+
+    def fetch(self):
+        try:
+            self.response = fetch_order_status(self.client, self.order_id)
+        except Exception as e:
+            self.error = e
+
+    def apply(self):
+        """
+        Applies the result to the payment. Changes to the ``TalerOrder`` row itself are
+        not saved, the caller writes them for the whole chunk at once.
+        """
+        payment = self.payment
+        t = self.taler_order
+        previous_state = payment.state
+        try:
+            if not self.order_id and payment.info_data.get("preparing"):
+                if now() - payment.created > timedelta(minutes=5):
+                    # The background task creating the merchant order got lost
+                    self.provider._create_merchant_order(payment)
+                    t.refresh_from_db(
+                        fields=[
+                            "poll_until",
+                            "order_id",
+                            "pay_deadline",
+                            "refund_deadline",
+                        ]
+                    )
+            elif not self.order_id:
+                # Fails the payment, we never created a merchant order for it
+                self.provider._query_and_process(payment)
+            elif self.unchanged:
+                pass
+            elif self.error:
+                self.provider._poll_failed(payment, self.error)
+            else:
+                self.provider._process_order_status(
+                    payment, self.response, t, bulk=True
+                )
+        except PaymentException:
+            pass
+        except Exception:
+            # One broken payment must not keep the other rows of the chunk from being
+            # rescheduled
+            logger.exception("Failed to process Taler payment %s", payment.full_id)
+        else:
+            if self.order_id:
+                t.last_polled_at = now()
+
+        self.confirmed = (
+            previous_state != OrderPayment.PAYMENT_STATE_CONFIRMED
+            and payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+        )
+        t.schedule_next_poll(push=self.push)
+
+
+def expire_payments():
+    """
+    Fails all pending payments whose pay deadline passed, provided the merchant
+    backend confirmed after the deadline that the order has not been paid. Only
+    payments of this worker's shard are considered. Returns the number of expired
+    payments.
+    """
+    expired = (
+        _in_shard(TalerOrder.objects.all())
+        .filter(
+            Q(pay_deadline__lt=now(), last_polled_at__gt=F("pay_deadline"))
+            | Q(
+                pay_deadline__isnull=True,
+                payment__created__lt=now() - timedelta(hours=1),
+            ),
+            payment__state__in=(
+                OrderPayment.PAYMENT_STATE_CREATED,
+                OrderPayment.PAYMENT_STATE_PENDING,
+            ),
+        )
+        .select_related("payment", "payment__order")
+    )
+    retired = []
+    for t in expired:
+        t.payment.fail(log_data={"cause": "expired"})
+        retired.append(t.pk)
+    if retired:
+        TalerOrder.objects.filter(pk__in=retired).update(next_poll_at=None)
+    return len(retired)
+
+
+def fetch_concurrently(jobs, workers, workers_per_backend):
+    """
+    Runs the HTTP part of all jobs on a bounded thread pool. At most
+    ``workers_per_backend`` requests are in flight for the same merchant backend.
+    """
+    semaphores = {
+        url: threading.BoundedSemaphore(workers_per_backend)
+        for url in {j.client.merchant_api_url for j in jobs}
+    }
+
+    def run(job):
+        with semaphores[job.client.merchant_api_url]:
+            job.fetch()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run, jobs))
+
+
+def batch_cursor_key(client):
+    h = hashlib.sha1(
+        f"{client.merchant_api_url}:{client.merchant_api_key}".encode()
+    ).hexdigest()
+    return f"pretix_taler:batch_cursor:{h}"
+
+
+def scan_paid_orders(client):
+    """
+    Returns the IDs of the orders in the merchant's list of paid orders that were
+    created after the oldest payment we are still waiting for.
+
+    Orders keep their position in the list when they are paid, so the scan needs to
+    go back to the oldest order that can still be paid. Everything before it is done
+    for good: the row ID of the last such entry is stored per merchant backend and
+    account, and the next scan starts after it. The first scan reads the list
+    backwards until it finds such an entry.
+    """
+    oldest = TalerOrder.objects.filter(
+        next_poll_at__isnull=False,
+        payment__state__in=(
+            OrderPayment.PAYMENT_STATE_CREATED,
+            OrderPayment.PAYMENT_STATE_PENDING,
+        ),
+    ).aggregate(oldest=Min("payment__created"))["oldest"]
+    # Leeway for clock skew between us and the merchant backend
+    since = ((oldest or now()) - timedelta(hours=1)).timestamp()
+    page_size = config_int("batch_page_size", 100)
+
+    cursor = cache.get(batch_cursor_key(client))
+    paid = set()
+    if cursor is None:
+        for o in list_orders(client, page_size=page_size, descending=True, paid="yes"):
+            if o["timestamp"]["t_s"] < since:
+                cursor = o["row_id"]
+                break
+            paid.add(o["order_id"])
+    else:
+        for o in list_orders(client, page_size=page_size, start=cursor, paid="yes"):
+            if o["timestamp"]["t_s"] < since:
+                cursor = o["row_id"]
+            else:
+                paid.add(o["order_id"])
+    if cursor is not None:
+        cache.set(batch_cursor_key(client), cursor, 30 * 24 * 3600)
+    return paid
+
+
+def reconcile_batch(jobs, scans):
+    """
+    Uses the order list of a merchant backend to find the pending payments that have
+    been paid. All other pending payments are marked as unchanged.
+
+    All jobs need to share the same merchant backend and API key. The list is only
+    scanned once per run of the periodic task, ``scans`` keeps the results.
+    """
+    client = jobs[0].client
+    k = (client.merchant_api_url, client.merchant_api_key)
+    if k not in scans:
+        scans[k] = scan_paid_orders(client)
+    for j in jobs:
+        j.unchanged = j.order_id not in scans[k]
+
+
+def poll_cursor_key():
+    # Workers of different shards poll different rows and need their own position
+    shard_count = config_int("shard_count", 1)
+    shard_index = config_int("shard_index", 0) if shard_count > 1 else 0
+    return f"pretix_taler:poll_cursor:{shard_count}:{shard_index}"
+
+
+# Orderings of the poll set. "due" polls the rows that have been waiting the longest
+# first, "newest" prefers recent payments, which are most likely to be paid soon.
+POLL_ORDERINGS = {
+    "due": ("next_poll_at", "pk"),
+    "newest": ("-pk",),
+}
+
+
+def _in_shard(qs):
+    shard_count = config_int("shard_count", 1)
+    if shard_count > 1:
+        # Static sharding: every worker is configured to handle a disjoint part of the
+        # payments
+        qs = qs.annotate(shard=Mod("payment_id", shard_count)).filter(
+            shard=config_int("shard_index", 0)
+        )
+    return qs
+
+
+def _due_orders():
+    return _in_shard(TalerOrder.objects.filter(next_poll_at__lte=now()))
+
+
+def _after_cursor(qs, ordering, cursor):
+    if ordering == "newest":
+        return qs.filter(pk__lt=cursor["pk"])
+    return qs.filter(
+        Q(next_poll_at__gt=cursor["next_poll_at"])
+        | Q(next_poll_at=cursor["next_poll_at"], pk__gt=cursor["pk"])
+    )
+
+
+def _load(pks):
+    rows = (
+        TalerOrder.objects.filter(pk__in=pks)
+        .select_related("payment", "payment__order", "payment__order__event")
+        .prefetch_related("payment__refunds")
+    )
+    rows = {t.pk: t for t in rows}
+    return [rows[pk] for pk in pks if pk in rows]
+
+
+def lease_duration(chunk_size):
+    """
+    Upper bound for the time it takes to poll a chunk of the given size: every
+    request may use up its full timeouts and rate limit wait, and in the worst case
+    all rows belong to the same backend, so at most ``poll_workers_per_backend``
+    requests run at the same time. ``poll_lease`` is used if it is longer.
+    """
+    connect_timeout, read_timeout = default_timeout()
+    per_request = connect_timeout + read_timeout + config_float("rate_limit_wait", 5)
+    parallel = max(
+        1,
+        min(config_int("poll_workers", 8), config_int("poll_workers_per_backend", 4)),
+    )
+    # Leeway for the probe, the batch reconciliation and the database work
+    bound = math.ceil(chunk_size / parallel) * per_request + 120
+    return timedelta(seconds=max(config_int("poll_lease", 300), bound))
+
+
+def _claim(qs, ordering, chunk_size):
+    """
+    Leases the next chunk of rows to this worker by moving their ``next_poll_at``
+    into the future, far enough that the chunk is done before the lease expires.
+    Rows locked by other workers in the meantime are skipped. If we crash while
+    polling, the rows become due again once the lease expires.
+    """
+    with transaction.atomic():
+        qs = qs.order_by(*POLL_ORDERINGS[ordering])
+        if connection.features.has_select_for_update_skip_locked:
+            qs = qs.select_for_update(skip_locked=True)
+        claimed = list(qs.values_list("pk", "next_poll_at")[:chunk_size])
+        TalerOrder.objects.filter(pk__in=[pk for pk, _ in claimed]).update(
+            next_poll_at=now() + lease_duration(chunk_size)
+        )
+    return claimed
+
+
+def iter_due_orders(ordering, cursor, chunk_size, leases=True):
+    """
+    Yields chunks of due rows in the given ordering. If a previous run stopped at
+    ``cursor``, we continue after it and only then come back to the start. Rows polled
+    in this run have been rescheduled and are not due anymore at that point.
+
+    With ``leases``, every chunk is claimed before it is yielded, so several workers
+    can poll at the same time without processing the same rows.
+    """
+    querysets = [_due_orders()]
+    if cursor and cursor.get("ordering") == ordering:
+        querysets.insert(0, _after_cursor(_due_orders(), ordering, cursor))
+
+    for qs in querysets:
+        if leases:
+            while True:
+                claimed = _claim(qs, ordering, chunk_size)
+                if not claimed:
+                    break
+                # The cursor needs the position from before the claim
+                last_pk, last_next_poll_at = claimed[-1]
+                yield _load([pk for pk, _ in claimed]), {
+                    "ordering": ordering,
+                    "next_poll_at": last_next_poll_at,
+                    "pk": last_pk,
+                }
+            continue
+
+        chunk = []
+        for t in (
+            qs.select_related("payment", "payment__order", "payment__order__event")
+            .prefetch_related("payment__refunds")
+            .order_by(*POLL_ORDERINGS[ordering])
+            .iterator(chunk_size=chunk_size)
+        ):
+            chunk.append(t)
+            if len(chunk) >= chunk_size:
+                yield chunk, _cursor(ordering, chunk)
+                chunk = []
+        if chunk:
+            yield chunk, _cursor(ordering, chunk)
+
+
+def _cursor(ordering, chunk):
+    return {
+        "ordering": ordering,
+        "next_poll_at": chunk[-1].next_poll_at,
+        "pk": chunk[-1].pk,
+    }
+
+
+def poll_due_orders():
+    """
+    Polls due orders in chunks until all are done or the time budget of this run is
+    used up. In the latter case, the position is stored so the next run resumes there.
+
+    With leases, several workers poll the same rows concurrently and no position is
+    stored: rows polled by any of them are rescheduled and no longer due anyway.
+    """
+    budget = config_float("poll_time_budget", 60)
+    ordering = config_str("poll_order", "due")
+    if ordering not in POLL_ORDERINGS:
+        ordering = "due"
+    started = time.monotonic()
+    due = TalerOrder.objects.filter(next_poll_at__lte=now()).count()
+    stats = defaultdict(int)
+    contexts = {}
+    scans = {}
+    leases = config_bool("poll_leases", True)
+    cursor_key = poll_cursor_key()
+
+    for chunk, cursor in iter_due_orders(
+        ordering,
+        None if leases else cache.get(cursor_key),
+        config_int("poll_chunk_size", 200),
+        leases=leases,
+    ):
+        for k, v in poll_chunk(chunk, contexts, scans).items():
+            stats[k] += v
+        if budget and time.monotonic() - started > budget:
+            if not leases:
+                cache.set(cursor_key, cursor, 24 * 3600)
+            logger.info("Taler poll run stopped after its time budget was used up")
+            break
+    else:
+        if not leases:
+            cache.delete(cursor_key)
+
+    expired = expire_payments()
+    observe_poll_cycle(
+        due=due,
+        processed=stats["processed"],
+        confirmed=stats["confirmed"],
+        expired=expired,
+        duration=time.monotonic() - started,
+    )
+
+
+def poll_chunk(taler_orders, contexts=None, scans=None, batch=True):
+    workers = config_int("poll_workers", 8)
+    workers_per_backend = config_int("poll_workers_per_backend", 4)
+
+    if contexts is None:
+        contexts = {}
+    if scans is None:
+        scans = {}
+    jobs = [PollJob(t, event_context(contexts, t.payment)) for t in taler_orders]
+    # Backends with an open circuit are probed if their cooldown passed, all others are
+    # not contacted at all in this run
+    unavailable = set()
+    for url in {j.client.merchant_api_url for j in jobs if j.order_id}:
+        health = BackendHealth(url)
+        health.probe()
+        if health.is_open:
+            unavailable.add(url)
+    skipped = {
+        j for j in jobs if j.order_id and j.client.merchant_api_url in unavailable
+    }
+    if skipped:
+        TalerOrder.objects.filter(pk__in=[j.taler_order.pk for j in skipped]).update(
+            next_poll_at=now() + timedelta(seconds=config_float("circuit_cooldown", 60))
+        )
+        jobs = [j for j in jobs if j not in skipped]
+
+    batch_threshold = config_int("batch_threshold", 20)
+    if batch and batch_threshold:
+        groups = defaultdict(list)
+        for j in jobs:
+            # The order list does not tell whether the refunds of an order changed,
+            # so confirmed payments are always polled one by one
+            if j.order_id and j.payment.state in (
+                OrderPayment.PAYMENT_STATE_CREATED,
+                OrderPayment.PAYMENT_STATE_PENDING,
+            ):
+                groups[j.client.merchant_api_url, j.client.merchant_api_key].append(j)
+        for group in groups.values():
+            if len(group) < batch_threshold:
+                continue
+            try:
+                reconcile_batch(group, scans)
+            except Exception:
+                logger.exception(
+                    "Batch reconciliation failed, polling orders one by one"
+                )
+                for j in group:
+                    j.unchanged = False
+
+    fetchable = [j for j in jobs if j.order_id and not j.unchanged]
+    if workers > 1:
+        fetch_concurrently(fetchable, workers, workers_per_backend)
+    else:
+        for j in fetchable:
+            j.fetch()
+
+    # Database changes are applied sequentially on the main thread. Only actual state
+    # changes of payments and refunds are written one by one, the bookkeeping of all
+    # rows is written in a single query.
+    for j in jobs:
+        j.apply()
+    TalerOrder.objects.bulk_update(
+        [j.taler_order for j in jobs],
+        ["next_poll_at", "last_polled_at", "refunds_processed"],
+    )
+    return {
+        "processed": len(jobs),
+        "confirmed": sum(1 for j in jobs if j.confirmed),
+    }
+
+
+WATCH_TASK_KEY = "pretix_taler:watch_task"
+# Upper bound for the runtime of one fast lane task. If payment pages are still open
+# afterwards, their next status check starts a new one.
+WATCH_TASK_RUNTIME = 300
+
+
+def fast_lane_available():
+    """
+    The fast lane runs as a Celery task and is coordinated through the cache, so it
+    needs both a worker and a cache shared by all processes.
+    """
+    return settings.HAS_CELERY and settings.REAL_CACHE_USED
+
+
+def mark_watched(payment):
+    """
+    Records that a customer currently looks at the payment page of ``payment`` and
+    makes sure the fast lane is running. Called on every status check of the page,
+    but only writes to the database every few seconds. Returns whether the fast lane
+    takes care of the payment, otherwise the page needs to ask the merchant itself.
+    """
+    from pretix_taler.tasks import poll_watched_orders
+
+    if not fast_lane_available():
+        return False
+    if cache.add(
+        f"pretix_taler:watched:{payment.pk}", "1", WATCH_DURATION.seconds // 3
+    ):
+        TalerOrder.objects.filter(payment=payment).update(
+            watched_until=now() + WATCH_DURATION
+        )
+    if cache.add(WATCH_TASK_KEY, "1", WATCH_TASK_RUNTIME + 60):
+        transaction.on_commit(lambda: poll_watched_orders.apply_async())
+    return True
+
+
+def poll_watched_orders():
+    """
+    Polls all payments whose payment page is currently open once. Returns whether any
+    such payments are left.
+    """
+    pks = list(
+        TalerOrder.objects.filter(
+            watched_until__gt=now(),
+            order_id__isnull=False,
+            payment__state__in=(
+                OrderPayment.PAYMENT_STATE_CREATED,
+                OrderPayment.PAYMENT_STATE_PENDING,
+            ),
+        )
+        .order_by("watched_until")
+        .values_list("pk", flat=True)[: config_int("poll_chunk_size", 200)]
+    )
+    if pks:
+        # The order list is scanned by the periodic task. Scanning it every few seconds
+        # for open payment pages would cost more than polling them one by one.
+        poll_chunk(_load(pks), batch=False)
+    return bool(pks)
+
+
+def run_fast_lane():
+    """
+    Polls the watched payments every ``watch_interval`` seconds until no payment page
+    is open anymore or ``WATCH_TASK_RUNTIME`` is reached.
+    """
+    interval = config_float("watch_interval", 5)
+    stop = time.monotonic() + WATCH_TASK_RUNTIME
+    while poll_watched_orders() and time.monotonic() + interval < stop:
+        time.sleep(interval)
@@ -0,0 +1,30 @@
+import hashlib
+import qrcode
+import qrcode.image.svg
+from django.core.cache import cache
+from io import BytesIO
+
+
+def qr_code_etag(uri):
+    return hashlib.sha1(uri.encode()).hexdigest()
+
+
+def qr_code_svg(uri):
+    """
+    Renders ``uri`` as a QR code in SVG format. Taler pay URIs never change once the
+    merchant order exists, so rendered codes are kept in the cache.
+    """
+    key = f"pretix_taler:qr:{qr_code_etag(uri)}"
+    svg = cache.get(key)
+    if svg is None:
+        img = qrcode.make(
+            uri,
+            image_factory=qrcode.image.svg.SvgPathImage,
+            box_size=10,
+            border=2,
+        )
+        buf = BytesIO()
+        img.save(buf)
+        svg = buf.getvalue()
+        cache.set(key, svg, 7 * 24 * 3600)
+    return svg
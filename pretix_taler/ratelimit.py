@@ -0,0 +1,79 @@
+import hashlib
+import math
+import random
+import time
+from django.core.cache import cache
+
+from pretix_taler.utils import config_float
+
+
+class RateLimiter:
+    """
+    Limits the number of requests per second to a merchant backend across all
+    processes, with one counter per one-second window in Django's cache.
+
+    All requests count against the same limit of ``rate_limit`` requests per second.
+    Background requests (polling, refunds) may only use the first
+    ``rate_limit_background_share`` of each window, the rest is reserved for
+    interactive requests (checkout, payment page), so a polling burst never delays
+    a customer.
+
+    With ``name`` and ``rate``, a separate counter with its own limit is kept for the
+    same backend, e.g. for refunds, which count against both.
+    """
+
+    def __init__(self, merchant_api_url, name=None, rate=None):
+        h = hashlib.sha1(merchant_api_url.encode()).hexdigest()
+        self.key_prefix = f"pretix_taler:ratelimit:{h}"
+        if name:
+            self.key_prefix += f":{name}"
+        self.rate = rate
+
+    def _take(self, key, limit):
+        if (cache.get(key) or 0) >= limit:
+            return False
+        cache.add(key, 0, 10)
+        try:
+            # incr is atomic with the Redis and Memcached backends
+            count = cache.incr(key)
+        except ValueError:
+            # The key expired in the meantime
+            cache.set(key, 1, 10)
+            count = 1
+        if count > limit:
+            # Another process was faster. Rejected attempts must not use up the
+            # budget, so the slot is given back.
+            try:
+                cache.decr(key)
+            except ValueError:
+                pass
+            return False
+        return True
+
+    def try_acquire(self, background=False):
+        rate = self.rate if self.rate is not None else config_float("rate_limit", 0)
+        if not rate:
+            return True
+        limit = rate
+        if background:
+            # At least one background request per window, otherwise polling and
+            # refunds would never get through with a small limit
+            limit = max(
+                1, math.floor(rate * config_float("rate_limit_background_share", 0.5))
+            )
+        return self._take(f"{self.key_prefix}:{int(time.time())}", limit)
+
+    def acquire(self, background=False, timeout=5):
+        """
+        Waits for a free slot for up to ``timeout`` seconds and returns whether one
+        was found.
+        """
+        give_up = time.monotonic() + timeout
+        while not self.try_acquire(background):
+            # Retry right after the next window started, with some jitter so waiting
+            # processes do not all come back at the same moment
+            wait = 1 - time.time() % 1 + random.uniform(0, 0.1)
+            if time.monotonic() + wait > give_up:
+                return False
+            time.sleep(wait)
+        return True
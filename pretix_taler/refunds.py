@@ -0,0 +1,192 @@
+import logging
+import random
+import requests
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from django.core.cache import cache
+from django.utils.timezone import now
+from pretix.base.models import OrderRefund
+
+from pretix_taler.models import TalerOrder
+from pretix_taler.payment import fetch_order_status
+from pretix_taler.ratelimit import RateLimiter
+from pretix_taler.status import invalidate_order_status
+from pretix_taler.utils import config_float, config_int
+
+logger = logging.getLogger(__name__)
+
+
+def queue_lock_key(event):
+    return f"pretix_taler:refund_queue:{event.pk}:lock"
+
+
+def queue_scheduled_key(event):
+    return f"pretix_taler:refund_queue:{event.pk}:scheduled"
+
+
+def progress_key(event):
+    return f"pretix_taler:refund_queue:{event.pk}:progress"
+
+
+class RefundJob:
+    def __init__(self, refund, provider):
+        self.refund = refund
+        # Settings are resolved here, on the main thread, so the worker threads never
+        # need to access the database.
+        self.client = provider.get_merchant_client(background=True)
+        # Shared by all events and processes using the same merchant backend
+        self.rate_limit = RateLimiter(
+            self.client.merchant_api_url, "refunds", config_float("refund_rate", 10)
+        )
+        self.order_id = refund.payment.info_data["order_id"]
+        self.path, self.payload = provider._refund_request(refund)
+        # Set if an earlier run already started to submit this refund and got
+        # interrupted, so it might have reached the merchant
+        self.resumed = bool(refund.info_data.get("submitting"))
+        self.response = None
+        self.error = None
+
+    def already_submitted(self):
+        resp = fetch_order_status(self.client, self.order_id, use_cache=False)
+        return any(
+            d["reason"].startswith(f"{self.refund.full_id} ")
+            for d in resp.get("refund_details") or []
+        )
+
+    def submit(self, attempts):
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(min(2**attempt, 60) * random.uniform(0.5, 1.5))
+            if attempt or self.resumed:
+                # A previous attempt might have reached the merchant even though we
+                # did not get a response. Our refund ID in the reason tells us.
+                try:
+                    if self.already_submitted():
+                        self.response = {}
+                        self.error = None
+                        return
+                except requests.RequestException as e:
+                    self.error = str(e)
+                    continue
+
+            if not self.rate_limit.acquire(timeout=60):
+                self.error = "Too many refunds are being sent to the merchant backend."
+                continue
+            try:
+                r = self.client.post(self.path, json=self.payload)
+            except requests.RequestException as e:
+                self.error = str(e)
+                continue
+            if r.status_code in (200, 201):
+                self.response = r.json()
+                self.error = None
+                return
+            self.error = r.text
+            if r.status_code < 500 and r.status_code != 429:
+                # Not a transient problem, retrying will not help
+                return
+
+
+def queued_refunds(event):
+    refunds = OrderRefund.objects.filter(
+        order__event=event,
+        provider="taler",
+        state=OrderRefund.REFUND_STATE_TRANSIT,
+        info__contains='"queued": true',
+    ).select_related("payment", "order")
+    return [r for r in refunds if r.info_data.get("queued")]
+
+
+def submit_queued_refunds(event):
+    """
+    Submits all queued refunds of an event to the merchant backend concurrently, at a
+    limited rate and with retries. Refunds closest to their refund deadline go first.
+    """
+    if not cache.add(queue_lock_key(event), "1", 3600):
+        # Another worker is already processing the queue of this event
+        return
+    try:
+        cache.delete(queue_scheduled_key(event))
+        provider = event.get_payment_providers().get("taler")
+        refunds = queued_refunds(event)
+        if not refunds:
+            return
+        deadlines = dict(
+            TalerOrder.objects.filter(
+                payment__in=[r.payment_id for r in refunds]
+            ).values_list("payment_id", "refund_deadline")
+        )
+        refunds.sort(
+            key=lambda r: deadlines.get(r.payment_id)
+            or datetime.max.replace(tzinfo=timezone.utc)
+        )
+
+        # Shown in the payment settings of the event
+        progress = {"total": len(refunds), "done": 0, "failed": 0, "finished": False}
+        cache.set(progress_key(event), progress, 24 * 3600)
+
+        jobs = []
+        for r in refunds:
+            if not deadlines.get(r.payment_id) or deadlines[r.payment_id] < now():
+                _refund_failed(r, "The refund deadline has passed.")
+                progress["failed"] += 1
+            else:
+                jobs.append(RefundJob(r, provider))
+        # Lets a later run know which refunds might have been submitted already if
+        # this one is interrupted
+        for j in jobs:
+            j.refund.info_data = {**j.refund.info_data, "submitting": True}
+        OrderRefund.objects.bulk_update([j.refund for j in jobs], ["info"])
+
+        attempts = config_int("refund_attempts", 5)
+        with ThreadPoolExecutor(
+            max_workers=config_int("refund_workers", 4)
+        ) as executor:
+            futures = {executor.submit(j.submit, attempts): j for j in jobs}
+            # Database changes are applied on the main thread as results come in
+            for future in as_completed(futures):
+                j = futures[future]
+                if j.response is not None:
+                    _refund_submitted(j)
+                    progress["done"] += 1
+                else:
+                    _refund_failed(j.refund, j.error)
+                    progress["failed"] += 1
+                cache.set(progress_key(event), progress, 24 * 3600)
+
+        progress["finished"] = True
+        cache.set(progress_key(event), progress, 24 * 3600)
+        logger.info(
+            "Submitted %d Taler refunds for event %s, %d failed",
+            progress["done"],
+            event.slug,
+            progress["failed"],
+        )
+        event.log_action("pretix_taler.refunds.submitted", data=progress)
+    finally:
+        cache.delete(queue_lock_key(event))
+
+
+def _refund_submitted(job):
+    invalidate_order_status(job.client.merchant_api_url, job.order_id)
+    job.refund.info_data = job.response
+    job.refund.save(update_fields=["info"])
+    # Look for the completion of the refund soon
+    TalerOrder.objects.filter(
+        payment=job.refund.payment, next_poll_at__isnull=False
+    ).update(next_poll_at=now())
+
+
+def _refund_failed(refund, message):
+    refund.info_data = {"error": True, "message": message}
+    refund.state = OrderRefund.REFUND_STATE_FAILED
+    refund.save(update_fields=["info", "state"])
+    refund.order.log_action(
+        "pretix.event.order.refund.failed",
+        {
+            "local_id": refund.local_id,
+            "provider": refund.provider,
+            "message": message,
+        },
+    )
@@ -1,15 +1,10 @@
 import logging
-import time
 from datetime import timedelta
 from django.dispatch import receiver
 from django.utils.timezone import now
 from django_scopes import scopes_disabled
-from pretix.base.models import OrderPayment
-from pretix.base.payment import PaymentException
 from pretix.base.signals import periodic_task, register_payment_providers
 
-from pretix_taler.models import TalerOrder
-
 logger = logging.getLogger(__name__)
 
 
@@ -23,21 +18,27 @@ def register_payment_provider(sender, **kwargs):
 @receiver(periodic_task, dispatch_uid="payment_taler_periodic_check")
 @scopes_disabled()
 def register_periodic_task(sender, **kwargs):
-    for t in TalerOrder.objects.filter(poll_until__gte=now()).select_related(
-        "payment", "payment__order", "payment__order__event"
+    from .polling import poll_due_orders
+
+    poll_due_orders()
+
+
+@receiver(periodic_task, dispatch_uid="payment_taler_refund_queue")
+@scopes_disabled()
+def process_stale_refund_queues(sender, **kwargs):
+    from pretix.base.models import OrderRefund
+
+    from .tasks import process_refund_queue
+
+    # Picks up queued refunds whose background task got lost
+    for event_id in (
+        OrderRefund.objects.filter(
+            provider="taler",
+            state=OrderRefund.REFUND_STATE_TRANSIT,
+            info__contains='"queued": true',
+            created__lt=now() - timedelta(minutes=10),
+        )
+        .values_list("order__event_id", flat=True)
+        .distinct()
     ):
-        try:
-            t.payment.payment_provider._query_and_process(t.payment)
-        except PaymentException:
-            continue
-        else:
-            if t.payment.state in (
-                OrderPayment.PAYMENT_STATE_CREATED,
-                OrderPayment.PAYMENT_STATE_PENDING,
-            ):
-                pay_deadline = t.payment.info_data.get("pay_deadline")
-                expired = (
-                    not pay_deadline and now() - t.payment.created > timedelta(hours=1)
-                ) or (pay_deadline and pay_deadline["t_s"] < time.time())
-                if expired:
-                    t.payment.fail(log_data={"cause": "expired"})
+        process_refund_queue.apply_async(kwargs={"event": event_id})
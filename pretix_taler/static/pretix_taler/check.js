@@ -1,16 +1,19 @@
 $(function () {
+    var preparing = $("[data-taler-preparing]").length;
+
     function check () {
         $.getJSON(
-            location.href + '?ajax=1',
+            location.href + '?ajax=1' + (preparing ? '&preparing=1' : ''),
         ).done(function (json) {
             if (json.refresh) {
                 location.reload()
             } else {
-                window.setTimeout(check, 10000);
+                window.setTimeout(check, json.retry === undefined ? 10000 : json.retry);
             }
         }).fail(function (jqxhr, textStatus, error) {
             window.setTimeout(check, 20000);
         })
     }
-    window.setTimeout(check, 10000);
-})
\ No newline at end of file
+
+    window.setTimeout(check, 1000);
+})
@@ -0,0 +1,73 @@
+import hashlib
+import time
+from django.core.cache import cache
+
+# Lifetime of cached order status responses. Orders that can no longer change are
+# kept much longer than those that can be paid or refunded at any moment.
+STATUS_CACHE_TTL = 5
+STATUS_CACHE_TTL_FINAL = 300
+# Upper bound for how long a request may hold the lock for an order status and how
+# long others wait for it before they give up and ask the merchant themselves
+STATUS_LOCK_TTL = 60
+STATUS_LOCK_WAIT = 10
+
+
+def order_status_cache_key(merchant_api_url, order_id):
+    h = hashlib.sha1(merchant_api_url.encode()).hexdigest()
+    return f"pretix_taler:order_status:{h}:{order_id}"
+
+
+def is_final(resp):
+    contract_terms = resp.get("contract_terms") or {}
+    if resp.get("order_status") == "paid":
+        deadline = contract_terms.get("refund_deadline")
+    else:
+        deadline = contract_terms.get("pay_deadline")
+    return (
+        isinstance(deadline, dict)
+        and isinstance(deadline.get("t_s"), int)
+        and deadline["t_s"] < time.time()
+    )
+
+
+def invalidate_order_status(merchant_api_url, order_id):
+    cache.delete(order_status_cache_key(merchant_api_url, order_id))
+
+
+def cached_order_status(merchant_api_url, order_id, fetch, use_cache=True):
+    """
+    Returns the order status from the cache or calls ``fetch`` to retrieve it. If
+    several callers ask for the same order at the same time, only one of them calls
+    ``fetch`` and the others wait for its result.
+
+    With ``use_cache=False``, the merchant is always asked, but the response is still
+    shared with waiting callers.
+    """
+    key = order_status_cache_key(merchant_api_url, order_id)
+    lock_key = f"{key}:lock"
+    if use_cache:
+        resp = cache.get(key)
+        if resp is not None:
+            return resp
+
+        locked = cache.add(lock_key, "1", STATUS_LOCK_TTL)
+        if not locked:
+            wait_until = time.monotonic() + STATUS_LOCK_WAIT
+            while time.monotonic() < wait_until and cache.get(lock_key):
+                time.sleep(0.1)
+                resp = cache.get(key)
+                if resp is not None:
+                    return resp
+        try:
+            return _fetch_and_store(key, fetch)
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+    return _fetch_and_store(key, fetch)
+
+
+def _fetch_and_store(key, fetch):
+    resp = fetch()
+    cache.set(key, resp, STATUS_CACHE_TTL_FINAL if is_final(resp) else STATUS_CACHE_TTL)
+    return resp
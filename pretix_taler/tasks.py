@@ -0,0 +1,62 @@
+import logging
+import requests
+from django.core.cache import cache
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, OrderPayment
+from pretix.base.payment import PaymentException
+from pretix.base.services.tasks import EventTask
+from pretix.celery_app import app
+
+logger = logging.getLogger(__name__)
+
+
+@app.task(base=EventTask)
+def create_merchant_order(event: Event, payment: int):
+    payment = OrderPayment.objects.select_related("order").get(
+        pk=payment, order__event=event
+    )
+    if (
+        payment.state != OrderPayment.PAYMENT_STATE_PENDING
+        or not payment.info_data.get("preparing")
+    ):
+        return
+    try:
+        payment.payment_provider._create_merchant_order(payment)
+    except PaymentException:
+        # The payment has been marked as failed and the customer will see the error
+        # on the payment page
+        pass
+
+
+@app.task(base=EventTask)
+def process_refund_queue(event: Event):
+    from pretix_taler.refunds import submit_queued_refunds
+
+    submit_queued_refunds(event)
+
+
+@app.task()
+def poll_watched_orders():
+    from pretix_taler import polling
+
+    try:
+        with scopes_disabled():
+            polling.run_fast_lane()
+    finally:
+        # Lets the next status check of a payment page start a new fast lane
+        cache.delete(polling.WATCH_TASK_KEY)
+
+
+@app.task()
+def refresh_capabilities(merchant_api_url: str):
+    from pretix_taler.capabilities import capabilities_cache_key, fetch_capabilities
+
+    try:
+        fetch_capabilities(merchant_api_url, background=True)
+    except requests.RequestException:
+        logger.info(
+            "Could not refresh capabilities of Taler merchant backend %s",
+            merchant_api_url,
+        )
+    finally:
+        cache.delete(f"{capabilities_cache_key(merchant_api_url)}:refresh")
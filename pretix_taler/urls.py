@@ -8,4 +8,14 @@ event_patterns = [
         views.ReturnView.as_view(),
         name="return",
     ),
+    path(
+        "_taler/pay/<str:order>/<str:hash>/<int:payment>/qr.svg",
+        views.QRCodeView.as_view(),
+        name="qr",
+    ),
+    path(
+        "_taler/webhook/",
+        views.WebhookView.as_view(),
+        name="webhook",
+    ),
 ]
@@ -0,0 +1,17 @@
+from django.conf import settings
+
+
+def config_str(key, fallback):
+    return settings.CONFIG_FILE.get("taler", key, fallback=fallback)
+
+
+def config_int(key, fallback):
+    return settings.CONFIG_FILE.getint("taler", key, fallback=fallback)
+
+
+def config_float(key, fallback):
+    return settings.CONFIG_FILE.getfloat("taler", key, fallback=fallback)
+
+
+def config_bool(key, fallback):
+    return settings.CONFIG_FILE.getboolean("taler", key, fallback=fallback)
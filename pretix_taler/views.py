@@ -1,16 +1,26 @@
 import hashlib
+import hmac
+import json
+import time
 from django.contrib import messages
-from django.http import Http404, JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.utils.decorators import method_decorator
+from django.utils.timezone import now
 from django.views.decorators.clickjacking import xframe_options_exempt
 from django.views.decorators.csrf import csrf_exempt
-from django.views.generic import TemplateView
+from django.views.generic import TemplateView, View
 from pretix.base.models import Order, OrderPayment
 from pretix.base.payment import PaymentException
 from pretix.multidomain.urlreverse import eventreverse
 from pretix.presale.views import EventViewMixin
 
+from pretix_taler.capabilities import set_supported, supports
+from pretix_taler.models import TalerOrder
+from pretix_taler.polling import mark_watched
+from pretix_taler.qr import qr_code_etag, qr_code_svg
+from pretix_taler.utils import config_int
+
 
 class TalerOrderView:
     def dispatch(self, request, *args, **kwargs):
@@ -54,22 +64,55 @@ class ReturnView(TalerOrderView, EventViewMixin, TemplateView):
             pk=self.kwargs["payment"],
             provider__startswith="taler",
         )
-        pp = self.payment.payment_provider
-
+        longpoll = False
+        longpoll_timeout = config_int("longpoll_timeout", 25)
         if self.payment.state != OrderPayment.PAYMENT_STATE_PENDING:
             if "ajax" in request.GET:
                 return JsonResponse({"refresh": True})
             return self._redirect_to_order()
+        elif self.payment.info_data.get("preparing"):
+            # The merchant order is still being created in the background
+            if "ajax" in request.GET:
+                return JsonResponse({"refresh": False, "retry": 1000})
+        elif "ajax" in request.GET and "preparing" in request.GET:
+            # The merchant order has been created since the page was rendered
+            return JsonResponse({"refresh": True})
         else:
-            try:
-                pp._query_and_process(self.payment)
-            except PaymentException as e:
-                messages.error(self.request, str(e))
-                if "ajax" in request.GET:
-                    return JsonResponse({"refresh": True})
-                self._redirect_to_order()
+            # While the page is open, the payment is polled in the fast lane and
+            # status checks only look at the state we know locally. Without the fast
+            # lane, status checks long-poll the merchant.
+            watched = mark_watched(self.payment)
+            merchant_api_url = self.payment.payment_provider.settings.merchant_api_url
+            longpoll = (
+                not watched
+                and "ajax" in request.GET
+                and longpoll_timeout
+                and supports(merchant_api_url, "longpoll")
+            )
+            if not watched or "ajax" not in request.GET:
+                started = time.monotonic()
+                try:
+                    self.payment.payment_provider._query_and_process(
+                        self.payment,
+                        timeout_ms=longpoll_timeout * 1000 if longpoll else None,
+                    )
+                except PaymentException as e:
+                    messages.error(self.request, str(e))
+                    if "ajax" in request.GET:
+                        return JsonResponse({"refresh": True})
+                    self._redirect_to_order()
         if "ajax" in request.GET:
-            return JsonResponse({"refresh": False})
+            if self.payment.state != OrderPayment.PAYMENT_STATE_PENDING:
+                return JsonResponse({"refresh": True})
+            if longpoll:
+                if time.monotonic() - started > longpoll_timeout / 2:
+                    # The merchant held the request, the client can ask again right
+                    # away
+                    return JsonResponse({"refresh": False, "retry": 0})
+                # Backends that answer early do not support long polling, there is no
+                # point in asking them to wait again
+                set_supported(merchant_api_url, "longpoll", False)
+            return JsonResponse({"refresh": False, "retry": 10000})
         return super().get(request, *args, **kwargs)
 
     def get_context_data(self, **kwargs):
@@ -77,5 +120,66 @@ class ReturnView(TalerOrderView, EventViewMixin, TemplateView):
             **super().get_context_data(**kwargs),
             "payment": self.payment,
             "order": self.payment.order,
-            "taler_url": self.payment.info_data["taler_pay_uri"],
+            "taler_url": self.payment.info_data.get("taler_pay_uri"),
+            "preparing": self.payment.info_data.get("preparing"),
+            "qr_url": self.payment.payment_provider._payment_url(self.payment, "qr"),
         }
+
+
+class QRCodeView(TalerOrderView, View):
+    def get(self, request, *args, **kwargs):
+        payment = get_object_or_404(
+            self.order.payments,
+            pk=self.kwargs["payment"],
+            provider__startswith="taler",
+        )
+        uri = payment.info_data.get("taler_pay_uri")
+        if not uri:
+            raise Http404("")
+
+        # The URL of a payment's QR code is only rendered once its pay URI is known,
+        # and the URI never changes afterwards
+        etag = f'"{qr_code_etag(uri)}"'
+        if request.headers.get("If-None-Match") == etag:
+            response = HttpResponse(status=304)
+        else:
+            response = HttpResponse(qr_code_svg(uri), content_type="image/svg+xml")
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, max-age=31536000, immutable"
+        return response
+
+
+@method_decorator(csrf_exempt, "dispatch")
+class WebhookView(View):
+    def post(self, request, *args, **kwargs):
+        pp = request.event.get_payment_providers().get("taler")
+        secret = pp.settings.webhook_secret if pp else None
+        if not secret or not hmac.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {secret}"
+        ):
+            return HttpResponse(status=403)
+
+        try:
+            order_id = json.loads(request.body)["order_id"]
+            t = TalerOrder.objects.select_related("payment", "payment__order").get(
+                order_id=str(order_id), payment__order__event=request.event
+            )
+        except (ValueError, KeyError, TypeError):
+            return HttpResponse(status=400)
+        except TalerOrder.DoesNotExist:
+            return HttpResponse(status=404)
+        payment = t.payment
+
+        # We do not trust the request body beyond the order ID, but ask the merchant
+        # backend for the actual state of the order.
+        try:
+            payment.payment_provider._query_and_process(
+                payment, use_cache=False, taler_order=t
+            )
+        except PaymentException:
+            return HttpResponse(status=502)
+
+        t.last_polled_at = now()
+        t.schedule_next_poll(push=True)
+        t.save(update_fields=["last_polled_at", "next_poll_at"])
+        return HttpResponse(status=204)
@@ -1 +1,121 @@
-# put your pytest fixtures here
+import pytest
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from fake_merchant import FakeMerchant
+from pretix.base.models import Event, Order, OrderPayment, Organizer
+
+BENCHMARK_RESULTS = []
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not BENCHMARK_RESULTS:
+        return
+    terminalreporter.section("Taler benchmarks")
+    for name, values in BENCHMARK_RESULTS:
+        terminalreporter.write_line(
+            f"{name:<50} "
+            + ", ".join(
+                f"{k}={v:.4f}" if isinstance(v, float) else f"{k}={v}"
+                for k, v in values.items()
+            )
+        )
+
+
+@pytest.fixture
+def benchmark_report():
+    def report(name, **values):
+        BENCHMARK_RESULTS.append((name, values))
+
+    return report
+
+
+@pytest.fixture(autouse=True)
+def clear_cache(settings):
+    # pretix' test settings come without a real cache, but the plugin coordinates
+    # processes through it
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    settings.REAL_CACHE_USED = True
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture
+def taler_config():
+    """
+    Allows to override options of the [taler] section of pretix.cfg in a test.
+    """
+    config = settings.CONFIG_FILE
+    created = not config.has_section("taler")
+    if created:
+        config.add_section("taler")
+    previous = dict(config.items("taler"))
+
+    def set_option(key, value):
+        config.set("taler", key, str(value))
+
+    yield set_option
+
+    config.remove_section("taler")
+    if not created:
+        config.add_section("taler")
+        for k, v in previous.items():
+            config.set("taler", k, v)
+
+
+@pytest.fixture
+def merchant():
+    m = FakeMerchant().start()
+    yield m
+    m.stop()
+
+
+@pytest.fixture
+def event(merchant):
+    with scopes_disabled():
+        o = Organizer.objects.create(name="Dummy", slug="dummy")
+        event = Event.objects.create(
+            organizer=o,
+            name="Dummy",
+            slug="dummy",
+            date_from=now() + timedelta(days=30),
+            plugins="pretix_taler",
+            currency="EUR",
+            live=True,
+        )
+        event.settings.set("payment_taler__enabled", True)
+        event.settings.set("payment_taler_merchant_api_url", merchant.url)
+        event.settings.set("payment_taler_merchant_api_key", "secret")
+        yield event
+
+
+@pytest.fixture
+def provider(event):
+    return event.get_payment_providers()["taler"]
+
+
+@pytest.fixture
+def make_payment(event):
+    def make(amount=Decimal("23.00")):
+        order = Order.objects.create(
+            event=event,
+            email="dummy@dummy.test",
+            status=Order.STATUS_PENDING,
+            datetime=now(),
+            expires=now() + timedelta(days=10),
+            total=amount,
+            locale="en",
+        )
+        return order.payments.create(
+            provider="taler",
+            amount=amount,
+            state=OrderPayment.PAYMENT_STATE_CREATED,
+        )
+
+    return make
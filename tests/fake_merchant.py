@@ -0,0 +1,258 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeMerchant:
+    """
+    In-process stand-in for the parts of the Taler merchant API used by the plugin.
+
+    ``latency`` delays every response by the given number of seconds. ``error_rate``
+    answers the given fraction of requests with a 500 response, and ``fail_next()``
+    lets the next requests fail deterministically.
+    """
+
+    def __init__(self, currency="EUR", latency=0, error_rate=0):
+        self.currency = currency
+        self.latency = latency
+        self.error_rate = error_rate
+        # Whether order status requests with timeout_ms wait for a payment
+        self.longpoll = True
+        self.orders = {}
+        self.requests = []
+        self._failures = []
+        self._delays = []
+        self._row_id = 0
+        self._changed = threading.Condition()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def fail_next(self, count=1, status=500):
+        self._failures.extend([status] * count)
+
+    def delay_next(self, seconds, count=1):
+        """
+        Processes the next requests normally, but only answers after ``seconds``.
+        """
+        self._delays.extend([seconds] * count)
+
+    def count(self, method, prefix):
+        return len(
+            [r for r in self.requests if r[0] == method and r[1].startswith(prefix)]
+        )
+
+    def add_order(self, order_id, amount, paid=False, created=None, **contract_terms):
+        """
+        Creates an order directly, without going through the API.
+        """
+        with self._changed:
+            self._row_id += 1
+            self.orders[order_id] = {
+                "row_id": self._row_id,
+                "order_id": order_id,
+                "amount": amount,
+                "created": int(created or time.time()),
+                "paid": paid,
+                "contract_terms": {"amount": amount, **contract_terms},
+                "refunds": [],
+            }
+            return self.orders[order_id]
+
+    def pay(self, order_id):
+        with self._changed:
+            self.orders[order_id]["paid"] = True
+            self._changed.notify_all()
+
+    def refund(self, order_id, amount, reason, pending=False):
+        with self._changed:
+            self.orders[order_id]["refunds"].append(
+                {
+                    "reason": reason,
+                    "pending": pending,
+                    "amount": amount,
+                    "timestamp": {"t_s": int(time.time())},
+                }
+            )
+            self._changed.notify_all()
+
+    def order_status(self, order_id):
+        o = self.orders[order_id]
+        if not o["paid"]:
+            return {
+                "order_status": "unpaid",
+                "taler_pay_uri": f"taler+http://pay/127.0.0.1/{order_id}/",
+                "creation_time": {"t_s": o["created"]},
+                "total_amount": o["amount"],
+                "summary": o["contract_terms"].get("summary", ""),
+            }
+        return {
+            "order_status": "paid",
+            "refunded": bool(o["refunds"]),
+            "refund_pending": any(r["pending"] for r in o["refunds"]),
+            "refund_details": list(o["refunds"]),
+            "deposit_total": o["amount"],
+            "contract_terms": o["contract_terms"],
+            "wired": False,
+        }
+
+    def _handler(self):
+        merchant = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status, body=None):
+                if self.delay:
+                    time.sleep(self.delay)
+                data = json.dumps(body).encode() if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _dispatch(self, method):
+                url = urlparse(self.path)
+                path = url.path.lstrip("/")
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                merchant.requests.append((method, path, query))
+                self.delay = merchant._delays.pop(0) if merchant._delays else 0
+                if merchant.latency:
+                    time.sleep(merchant.latency)
+                if merchant._failures:
+                    return self._respond(merchant._failures.pop(0), {"code": 1})
+                if merchant.error_rate and random.random() < merchant.error_rate:
+                    return self._respond(500, {"code": 1})
+                body = None
+                if method == "POST":
+                    length = int(self.headers.get("Content-Length") or 0)
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                return self._route(method, path, query, body)
+
+            def _route(self, method, path, query, body):
+                parts = path.split("/")
+                if method == "GET" and path == "config":
+                    return self._respond(
+                        200,
+                        {
+                            "name": "taler-merchant",
+                            "currency": merchant.currency,
+                            "version": "4:0:1",
+                        },
+                    )
+                if parts[:2] != ["private", "orders"]:
+                    return self._respond(404, {"code": 2})
+                if method == "POST" and len(parts) == 2:
+                    return self._create_order(body)
+                if method == "GET" and len(parts) == 2:
+                    return self._list_orders(query)
+                order_id = parts[2] if len(parts) > 2 else None
+                if order_id not in merchant.orders:
+                    return self._respond(404, {"code": 2000})
+                if method == "GET" and len(parts) == 3:
+                    return self._get_order(order_id, query)
+                if method == "POST" and parts[3:] == ["refund"]:
+                    merchant.refund(order_id, body["refund"], body["reason"])
+                    return self._respond(
+                        200,
+                        {
+                            "taler_refund_uri": f"taler+http://refund/127.0.0.1/{order_id}/",
+                            "h_contract": "0" * 64,
+                        },
+                    )
+                return self._respond(404, {"code": 2})
+
+            def _create_order(self, body):
+                order = body["order"]
+                existing = merchant.orders.get(order["order_id"])
+                if existing:
+                    # Replays of the same order are answered like the original request,
+                    # an order with the same ID but different content is a conflict
+                    if existing["amount"] != order["amount"]:
+                        return self._respond(409, {"code": 2170})
+                    return self._respond(
+                        200, {"order_id": order["order_id"], "token": "TOKEN"}
+                    )
+                merchant.add_order(
+                    order["order_id"],
+                    order["amount"],
+                    **{
+                        k: v
+                        for k, v in order.items()
+                        if k not in ("order_id", "amount")
+                    },
+                )
+                return self._respond(
+                    200, {"order_id": order["order_id"], "token": "TOKEN"}
+                )
+
+            def _get_order(self, order_id, query):
+                timeout_ms = int(query.get("timeout_ms", 0)) if merchant.longpoll else 0
+                with merchant._changed:
+                    merchant._changed.wait_for(
+                        lambda: merchant.orders[order_id]["paid"],
+                        timeout=timeout_ms / 1000,
+                    )
+                return self._respond(200, merchant.order_status(order_id))
+
+            def _list_orders(self, query):
+                delta = int(query.get("delta", -20))
+                start = int(query.get("start", 0 if delta > 0 else 2**63))
+                date_s = int(query.get("date_s", 0))
+                orders = sorted(merchant.orders.values(), key=lambda o: o["row_id"])
+                if delta < 0:
+                    orders = [o for o in reversed(orders) if o["row_id"] < start]
+                else:
+                    orders = [o for o in orders if o["row_id"] > start]
+                flags = {
+                    "paid": lambda o: o["paid"],
+                    "refunded": lambda o: bool(o["refunds"]),
+                }
+                for flag, check in flags.items():
+                    if flag in query:
+                        orders = [
+                            o for o in orders if check(o) == (query[flag] == "yes")
+                        ]
+                orders = [o for o in orders if o["created"] >= date_s]
+                return self._respond(
+                    200,
+                    {
+                        "orders": [
+                            {
+                                "order_id": o["order_id"],
+                                "row_id": o["row_id"],
+                                "timestamp": {"t_s": o["created"]},
+                                "amount": o["amount"],
+                                "summary": o["contract_terms"].get("summary", ""),
+                                "paid": o["paid"],
+                                "refundable": o["paid"],
+                            }
+                            for o in orders[: abs(delta)]
+                        ]
+                    },
+                )
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+        return Handler
@@ -0,0 +1,178 @@
+"""
+Benchmarks of the plugin against the fake merchant backend. The numbers are printed
+at the end of the test run. The periodic task benchmarks need a transactional database
+and large poll sets, so they only run with TALER_BENCHMARK_FULL=1.
+"""
+
+import os
+import pytest
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Order, OrderPayment
+
+from pretix_taler.models import TalerOrder
+from pretix_taler.polling import poll_due_orders
+
+FULL = os.environ.get("TALER_BENCHMARK_FULL") == "1"
+
+
+def _create_poll_set(event, merchant, size, paid_ratio=0.1):
+    """
+    Creates ``size`` pending payments with due TalerOrder rows and matching orders in
+    the fake merchant backend, bypassing the API for speed.
+    """
+    deadline = now() + timedelta(hours=1)
+    orders = Order.objects.bulk_create(
+        [
+            Order(
+                code=f"B{i:07d}",
+                secret=get_random_string(16),
+                event=event,
+                email="dummy@dummy.test",
+                status=Order.STATUS_PENDING,
+                datetime=now(),
+                expires=now() + timedelta(days=10),
+                total=Decimal("23.00"),
+                locale="en",
+            )
+            for i in range(size)
+        ],
+        batch_size=1000,
+    )
+    orders = list(Order.objects.filter(event=event, code__startswith="B"))
+    OrderPayment.objects.bulk_create(
+        [
+            OrderPayment(
+                order=o,
+                local_id=1,
+                provider="taler",
+                amount=Decimal("23.00"),
+                state=OrderPayment.PAYMENT_STATE_PENDING,
+                info=f'{{"order_id": "{o.code}-P-1"}}',
+            )
+            for o in orders
+        ],
+        batch_size=1000,
+    )
+    payments = OrderPayment.objects.filter(order__event=event, provider="taler")
+    TalerOrder.objects.bulk_create(
+        [
+            TalerOrder(
+                payment=p,
+                order_id=f"{p.order.code}-P-1",
+                poll_until=deadline + timedelta(days=8),
+                pay_deadline=deadline,
+                refund_deadline=deadline + timedelta(days=7),
+                next_poll_at=now(),
+            )
+            for p in payments.select_related("order")
+        ],
+        batch_size=1000,
+    )
+    for i, o in enumerate(orders):
+        merchant.add_order(
+            f"{o.code}-P-1",
+            "EUR:23.00",
+            paid=i < size * paid_ratio,
+        )
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_execute_payment_latency(provider, make_payment, benchmark_report):
+    durations = []
+    for i in range(50):
+        payment = make_payment()
+        start = time.perf_counter()
+        provider.execute_payment(None, payment)
+        durations.append(time.perf_counter() - start)
+
+    durations.sort()
+    benchmark_report(
+        "execute_payment",
+        mean_s=statistics.mean(durations),
+        p95_s=durations[int(len(durations) * 0.95)],
+    )
+
+
+@pytest.mark.skipif(not FULL, reason="slow, set TALER_BENCHMARK_FULL=1")
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("size", [1_000, 10_000, 100_000])
+@scopes_disabled()
+def test_periodic_task_throughput(
+    event, merchant, taler_config, benchmark_report, size
+):
+    taler_config("poll_time_budget", 0)
+    _create_poll_set(event, merchant, size)
+
+    start = time.perf_counter()
+    with CaptureQueriesContext(connection) as ctx:
+        poll_due_orders()
+    duration = time.perf_counter() - start
+
+    assert not TalerOrder.objects.filter(next_poll_at__lte=now()).exists()
+    assert (
+        OrderPayment.objects.filter(
+            order__event=event, state=OrderPayment.PAYMENT_STATE_CONFIRMED
+        ).count()
+        == size // 10
+    )
+    benchmark_report(
+        f"periodic task, {size} rows",
+        duration_s=duration,
+        rows_per_s=size / duration,
+        queries=len(ctx.captured_queries),
+        merchant_requests=len(merchant.requests),
+    )
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+@pytest.mark.parametrize("fast_lane", [True, False])
+def test_return_view_ajax_cost(
+    client,
+    provider,
+    make_payment,
+    merchant,
+    benchmark_report,
+    settings,
+    taler_config,
+    fast_lane,
+):
+    settings.HAS_CELERY = fast_lane
+    # Measures the cost of a check, not the time the merchant holds a long poll
+    taler_config("longpoll_timeout", 0)
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    url = provider._return_url(payment) + "?ajax=1"
+    merchant_requests = len(merchant.requests)
+
+    durations = []
+    queries = []
+    for i in range(50):
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            r = client.get(url)
+            durations.append(time.perf_counter() - start)
+        assert r.status_code == 200
+        assert r.json()["refresh"] is False
+        queries.append(len(ctx.captured_queries))
+
+    if fast_lane:
+        # Status checks only read the local state
+        assert len(merchant.requests) == merchant_requests
+    durations.sort()
+    benchmark_report(
+        "ReturnView AJAX " + ("(fast lane)" if fast_lane else "(without fast lane)"),
+        mean_s=statistics.mean(durations),
+        p95_s=durations[int(len(durations) * 0.95)],
+        queries=max(queries),
+        merchant_requests=len(merchant.requests) - merchant_requests,
+    )
@@ -0,0 +1,83 @@
+import pytest
+import time
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django_scopes import scopes_disabled
+
+from pretix_taler.capabilities import (
+    capabilities_cache_key,
+    get_capabilities,
+    set_supported,
+    supports,
+)
+
+
+def test_cached(merchant):
+    capabilities = get_capabilities(merchant.url)
+    assert capabilities["name"] == "taler-merchant"
+    assert capabilities["currency"] == "EUR"
+    assert get_capabilities(merchant.url) == capabilities
+    assert merchant.count("GET", "config") == 1
+
+
+def test_stale_entry_is_refreshed(merchant, taler_config):
+    taler_config("capabilities_ttl", 60)
+    get_capabilities(merchant.url)
+    key = capabilities_cache_key(merchant.url)
+    cache.set(
+        key, {**cache.get(key), "currency": "USD", "fetched_at": time.time() - 120}
+    )
+
+    # The stale entry is still served, the refresh happens in the background
+    assert get_capabilities(merchant.url)["currency"] == "USD"
+    assert merchant.count("GET", "config") == 2
+    assert cache.get(key)["currency"] == "EUR"
+
+
+def test_not_fetched_without_fetch(merchant):
+    assert get_capabilities("http://127.0.0.1:1/", fetch=False) is None
+
+
+def test_observed_features(merchant, taler_config):
+    get_capabilities(merchant.url)
+    # Features are assumed to be supported until the backend shows otherwise
+    assert supports(merchant.url, "longpoll")
+    set_supported(merchant.url, "longpoll", False)
+    assert not supports(merchant.url, "longpoll")
+
+    # A refresh of the configuration keeps what we learned
+    taler_config("capabilities_ttl", 0)
+    key = capabilities_cache_key(merchant.url)
+    cache.set(key, {**cache.get(key), "fetched_at": 0})
+    assert not supports(merchant.url, "longpoll")
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_settings_form_revalidates_stale_entry(provider, merchant):
+    get_capabilities(merchant.url)
+    key = capabilities_cache_key(merchant.url)
+    # The backend was misconfigured when it was last checked
+    cache.set(key, {**cache.get(key), "currency": "USD"})
+
+    data = {"payment_taler_merchant_api_url": merchant.url}
+    assert provider.settings_form_clean(data) == data
+    assert cache.get(key)["currency"] == "EUR"
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_settings_form_rejects_wrong_currency(provider, merchant):
+    merchant.currency = "USD"
+    with pytest.raises(ValidationError):
+        provider.settings_form_clean({"payment_taler_merchant_api_url": merchant.url})
+    assert merchant.count("GET", "config") == 2
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_settings_form_uses_cache(provider, merchant):
+    data = {"payment_taler_merchant_api_url": merchant.url}
+    provider.settings_form_clean(data)
+    provider.settings_form_clean(data)
+    assert merchant.count("GET", "config") == 1
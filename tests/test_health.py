@@ -0,0 +1,135 @@
+import pytest
+import time
+from django_scopes import scopes_disabled
+from pretix.base.payment import BasePaymentProvider
+
+from pretix_taler.client import MerchantClient, MerchantUnavailable
+from pretix_taler.health import BackendHealth
+
+
+def _fail(client, count):
+    for i in range(count):
+        assert client.get("config").status_code == 500
+
+
+def _cool_down(health):
+    state = health.state
+    state["open_until"] = time.time() - 1
+    health._save(state)
+
+
+@pytest.mark.django_db
+def test_circuit_opens_after_failures(merchant, taler_config):
+    taler_config("circuit_failures", 3)
+    client = MerchantClient(merchant.url)
+    merchant.fail_next(3)
+
+    _fail(client, 2)
+    assert client.health.circuit == "closed"
+    _fail(client, 1)
+    assert client.health.circuit == "open"
+
+    requests = len(merchant.requests)
+    with pytest.raises(MerchantUnavailable):
+        client.get("config")
+    assert len(merchant.requests) == requests
+
+
+@pytest.mark.django_db
+def test_success_resets_failures(merchant, taler_config):
+    taler_config("circuit_failures", 3)
+    client = MerchantClient(merchant.url)
+    merchant.fail_next(2)
+    _fail(client, 2)
+    client.get("config").raise_for_status()
+    merchant.fail_next(2)
+    _fail(client, 2)
+    assert client.health.circuit == "closed"
+
+
+@pytest.mark.django_db
+def test_half_open_trial_closes_circuit(merchant, taler_config):
+    taler_config("circuit_failures", 1)
+    client = MerchantClient(merchant.url)
+    merchant.fail_next(1)
+    _fail(client, 1)
+    assert client.health.circuit == "open"
+
+    _cool_down(client.health)
+    assert client.health.circuit == "half-open"
+    client.get("config").raise_for_status()
+    assert client.health.circuit == "closed"
+
+
+@pytest.mark.django_db
+def test_half_open_trial_failure_reopens_circuit(merchant, taler_config):
+    taler_config("circuit_failures", 1)
+    client = MerchantClient(merchant.url)
+    merchant.fail_next(2)
+    _fail(client, 1)
+    _cool_down(client.health)
+
+    _fail(client, 1)
+    assert client.health.circuit == "open"
+
+
+@pytest.mark.django_db
+def test_half_open_allows_one_trial_at_a_time(merchant, taler_config):
+    taler_config("circuit_failures", 1)
+    client = MerchantClient(merchant.url)
+    merchant.fail_next(1)
+    _fail(client, 1)
+    _cool_down(client.health)
+
+    assert client.health.start_trial()
+    with pytest.raises(MerchantUnavailable):
+        client.get("config")
+    client.health.end_trial()
+    client.get("config").raise_for_status()
+
+
+@pytest.mark.django_db
+def test_probe_closes_circuit(merchant, taler_config):
+    taler_config("circuit_failures", 1)
+    health = BackendHealth(merchant.url)
+    merchant.fail_next(1)
+    _fail(MerchantClient(merchant.url), 1)
+
+    health.probe()
+    # Still cooling down, the backend is not contacted
+    assert health.circuit == "open"
+    assert merchant.count("GET", "config") == 1
+
+    _cool_down(health)
+    health.probe()
+    assert health.circuit == "closed"
+
+
+@pytest.mark.django_db
+def test_failed_probe_keeps_circuit_open(merchant, taler_config):
+    taler_config("circuit_failures", 1)
+    health = BackendHealth(merchant.url)
+    merchant.fail_next(2)
+    _fail(MerchantClient(merchant.url), 1)
+    _cool_down(health)
+
+    health.probe()
+    assert health.circuit == "open"
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_provider_hidden_while_circuit_open(
+    provider, merchant, taler_config, monkeypatch
+):
+    monkeypatch.setattr(BasePaymentProvider, "is_allowed", lambda *args: True)
+    taler_config("circuit_failures", 1)
+    assert provider.is_allowed(None)
+
+    merchant.fail_next(1)
+    _fail(provider.merchant_client, 1)
+    assert not provider.is_allowed(None)
+
+    # After the cooldown, customers may try again
+    _cool_down(provider.merchant_client.health)
+    assert provider.is_allowed(None)
@@ -0,0 +1,92 @@
+import pytest
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+
+from pretix_taler.client import MerchantClient
+from pretix_taler.metrics import (
+    endpoint_name,
+    merchant_request_finished,
+    poll_cycle_finished,
+)
+from pretix_taler.models import TalerOrder
+from pretix_taler.polling import poll_due_orders
+from pretix_taler.status import invalidate_order_status
+
+
+@pytest.fixture
+def received():
+    received = []
+
+    def receiver(signal, sender, **kwargs):
+        received.append((signal, kwargs))
+
+    merchant_request_finished.connect(receiver, weak=False)
+    poll_cycle_finished.connect(receiver, weak=False)
+    yield received
+    merchant_request_finished.disconnect(receiver)
+    poll_cycle_finished.disconnect(receiver)
+
+
+def _sent(received, signal):
+    return [kwargs for s, kwargs in received if s is signal]
+
+
+@pytest.mark.parametrize(
+    "path,endpoint",
+    [
+        ("config", "config"),
+        ("private/orders", "private/orders"),
+        ("private/orders/abc-1", "private/orders/{order_id}"),
+        ("private/orders/abc-1/refund", "private/orders/{order_id}/refund"),
+    ],
+)
+def test_endpoint_name(path, endpoint):
+    assert endpoint_name(path) == endpoint
+
+
+@pytest.mark.django_db
+def test_merchant_request_finished(merchant, received):
+    MerchantClient(merchant.url).get("config")
+
+    (kwargs,) = _sent(received, merchant_request_finished)
+    duration = kwargs.pop("duration")
+    assert 0 <= duration < 5
+    assert kwargs == {
+        "merchant_api_url": merchant.url,
+        "method": "GET",
+        "endpoint": "config",
+        "status": 200,
+    }
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_merchant_request_finished_hides_order_ids(
+    provider, make_payment, merchant, received
+):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+
+    endpoints = [
+        (kwargs["method"], kwargs["endpoint"])
+        for kwargs in _sent(received, merchant_request_finished)
+    ]
+    assert ("POST", "private/orders") in endpoints
+    assert ("GET", "private/orders/{order_id}") in endpoints
+    assert not any(payment.full_id in e for m, e in endpoints)
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_poll_cycle_finished(provider, make_payment, merchant, received):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    merchant.pay(payment.full_id)
+    invalidate_order_status(merchant.url, payment.full_id)
+    TalerOrder.objects.filter(payment=payment).update(next_poll_at=now())
+
+    poll_due_orders()
+
+    (kwargs,) = _sent(received, poll_cycle_finished)
+    assert kwargs.pop("duration") >= 0
+    assert kwargs == {"due": 1, "processed": 1, "confirmed": 1, "expired": 0}
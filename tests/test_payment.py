@@ -0,0 +1,568 @@
+import json
+import pytest
+import threading
+from datetime import timedelta
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Order, OrderPayment, OrderRefund
+from pretix.base.payment import PaymentException
+
+from pretix_taler import tasks
+from pretix_taler.capabilities import get_capabilities, supports
+from pretix_taler.models import TalerOrder
+from pretix_taler.polling import (
+    expire_payments,
+    mark_watched,
+    poll_due_orders,
+    poll_watched_orders,
+    run_fast_lane,
+)
+from pretix_taler.status import invalidate_order_status
+
+
+def _make_due(payment):
+    # As if the status cached by the last request expired
+    invalidate_order_status(
+        payment.payment_provider.settings.merchant_api_url, payment.full_id
+    )
+    TalerOrder.objects.filter(payment=payment).update(next_poll_at=now())
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_execute_payment(provider, make_payment, merchant):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+    assert payment.info_data["order_id"] == payment.full_id
+    assert payment.info_data["taler_pay_uri"].startswith("taler+http://pay/")
+    assert "contract_terms" not in payment.info_data
+    assert merchant.orders[payment.full_id]["amount"] == "EUR:23.00"
+
+    t = TalerOrder.objects.get(payment=payment)
+    assert t.order_id == payment.full_id
+    assert t.pay_deadline > now()
+    assert t.refund_deadline > t.pay_deadline
+    assert now() < t.next_poll_at <= t.pay_deadline + timedelta(seconds=1)
+    assert t.poll_until < now() + timedelta(days=30)
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_execute_payment_merchant_down(provider, make_payment, merchant):
+    merchant.fail_next(3, status=500)
+    payment = make_payment()
+    with pytest.raises(PaymentException):
+        provider.execute_payment(None, payment)
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_execute_payment_retries_transient_failure(provider, make_payment, merchant):
+    merchant.fail_next(1, status=502)
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+    assert merchant.count("POST", "private/orders") == 2
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_execute_payment_replays_existing_order(provider, make_payment, merchant):
+    payment = make_payment()
+    # An earlier attempt reached the merchant, but we never saw the response
+    merchant.add_order(payment.full_id, "EUR:23.00")
+    provider.execute_payment(None, payment)
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+    assert payment.info_data["taler_pay_uri"]
+    assert TalerOrder.objects.get(payment=payment).order_id == payment.full_id
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_execute_payment_conflicting_order(provider, make_payment, merchant):
+    payment = make_payment()
+    merchant.add_order(payment.full_id, "EUR:42.00")
+    with pytest.raises(PaymentException):
+        provider.execute_payment(None, payment)
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+    assert merchant.count("POST", "private/orders") == 1
+    assert merchant.count("GET", f"private/orders/{payment.full_id}") == 1
+    assert merchant.orders[payment.full_id]["amount"] == "EUR:42.00"
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_execute_payment_recovers_order_after_timeout(
+    provider, make_payment, merchant, taler_config
+):
+    taler_config("read_timeout", 0.5)
+    payment = make_payment()
+    # The merchant creates the order, but answers too late
+    merchant.delay_next(1)
+    provider.execute_payment(None, payment)
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+    assert payment.info_data["taler_pay_uri"]
+    assert merchant.count("POST", "private/orders") == 1
+    assert TalerOrder.objects.get(payment=payment).order_id == payment.full_id
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_execute_payment_fails_after_timeout_without_order(
+    provider, make_payment, merchant, taler_config
+):
+    taler_config("read_timeout", 0.5)
+    payment = make_payment()
+    merchant.delay_next(1)
+    merchant.fail_next(1)
+    with pytest.raises(PaymentException):
+        provider.execute_payment(None, payment)
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+    assert merchant.count("POST", "private/orders") == 1
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_async_order_creation(
+    client,
+    provider,
+    make_payment,
+    merchant,
+    monkeypatch,
+    django_capture_on_commit_callbacks,
+):
+    provider.settings.set("async_order_creation", True)
+    queued = []
+    monkeypatch.setattr(
+        tasks.create_merchant_order, "apply_async", lambda kwargs: queued.append(kwargs)
+    )
+    payment = make_payment()
+    with django_capture_on_commit_callbacks(execute=True):
+        provider.execute_payment(None, payment)
+    assert queued == [{"event": payment.order.event_id, "payment": payment.pk}]
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+    assert payment.info_data == {"preparing": True}
+    assert not TalerOrder.objects.get(payment=payment).order_id
+    assert payment.full_id not in merchant.orders
+    url = provider._payment_url(payment, "return")
+    r = client.get(url, {"ajax": 1})
+    assert r.json() == {"refresh": False, "retry": 1000}
+
+    tasks.create_merchant_order.apply(kwargs=queued[0])
+
+    payment.refresh_from_db()
+    assert payment.info_data["order_id"] == payment.full_id
+    assert "preparing" not in payment.info_data
+    assert TalerOrder.objects.get(payment=payment).order_id == payment.full_id
+    assert payment.full_id in merchant.orders
+    # The page rendered while preparing reloads to show the QR code
+    r = client.get(url, {"ajax": 1, "preparing": 1})
+    assert r.json() == {"refresh": True}
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_async_order_creation_skips_handled_payments(provider, make_payment, merchant):
+    created = make_payment()
+    provider.execute_payment(None, created)
+    provider.settings.set("async_order_creation", True)
+    canceled = make_payment()
+    provider.execute_payment(None, canceled)
+    OrderPayment.objects.filter(pk=canceled.pk).update(
+        state=OrderPayment.PAYMENT_STATE_CANCELED
+    )
+
+    for payment in (created, canceled):
+        tasks.create_merchant_order.apply(
+            kwargs={"event": payment.order.event_id, "payment": payment.pk}
+        )
+
+    assert merchant.count("POST", "private/orders") == 1
+    assert canceled.full_id not in merchant.orders
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_poll_creates_order_if_background_task_got_lost(
+    provider, make_payment, merchant
+):
+    provider.settings.set("async_order_creation", True)
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    TalerOrder.objects.filter(payment=payment).update(next_poll_at=now())
+
+    poll_due_orders()
+    assert payment.full_id not in merchant.orders
+
+    OrderPayment.objects.filter(pk=payment.pk).update(
+        created=now() - timedelta(minutes=6)
+    )
+    TalerOrder.objects.filter(payment=payment).update(next_poll_at=now())
+    poll_due_orders()
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+    assert payment.info_data["order_id"] == payment.full_id
+    assert TalerOrder.objects.get(payment=payment).order_id == payment.full_id
+    assert payment.full_id in merchant.orders
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_poll_confirms_paid_payment(provider, make_payment, merchant):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    merchant.pay(payment.full_id)
+    _make_due(payment)
+
+    poll_due_orders()
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert payment.order.status == Order.STATUS_PAID
+    t = TalerOrder.objects.get(payment=payment)
+    assert t.last_polled_at is not None
+    assert t.next_poll_at > now()
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_poll_survives_failing_payment(provider, make_payment, merchant, monkeypatch):
+    broken, payment = make_payment(), make_payment()
+    provider.execute_payment(None, broken)
+    provider.execute_payment(None, payment)
+    merchant.pay(broken.full_id)
+    merchant.pay(payment.full_id)
+    _make_due(broken)
+    _make_due(payment)
+
+    confirm = OrderPayment.confirm
+
+    def failing_confirm(self, *args, **kwargs):
+        if self.pk == broken.pk:
+            raise ValueError("broken")
+        return confirm(self, *args, **kwargs)
+
+    monkeypatch.setattr(OrderPayment, "confirm", failing_confirm)
+    poll_due_orders()
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert TalerOrder.objects.get(payment=broken).next_poll_at > now()
+
+
+@pytest.fixture
+def fast_lane(settings):
+    settings.HAS_CELERY = True
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_watched_payment_is_polled_in_fast_lane(
+    provider, make_payment, merchant, fast_lane
+):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    assert not poll_watched_orders()
+
+    assert mark_watched(payment)
+    assert poll_watched_orders()
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+
+    merchant.pay(payment.full_id)
+    # The cached status expired
+    invalidate_order_status(merchant.url, payment.full_id)
+    poll_watched_orders()
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert not poll_watched_orders()
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_fast_lane_does_not_scan_order_list(
+    provider, make_payment, merchant, fast_lane, taler_config
+):
+    taler_config("batch_threshold", 2)
+    payments = [make_payment() for i in range(3)]
+    for p in payments:
+        provider.execute_payment(None, p)
+        mark_watched(p)
+
+    assert poll_watched_orders()
+    assert not [r for r in merchant.requests if r[1] == "private/orders"]
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_fast_lane_stops_when_nothing_is_watched(
+    provider, make_payment, merchant, fast_lane, taler_config
+):
+    taler_config("watch_interval", 0)
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    mark_watched(payment)
+    merchant.pay(payment.full_id)
+    fetched = merchant.count("GET", f"private/orders/{payment.full_id}")
+
+    run_fast_lane()
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert merchant.count("GET", f"private/orders/{payment.full_id}") == fetched + 1
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_no_fast_lane_without_celery(provider, make_payment, merchant, settings):
+    settings.HAS_CELERY = False
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+
+    assert not mark_watched(payment)
+    assert not poll_watched_orders()
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_poll_leaves_unpaid_payment_alone(provider, make_payment, merchant):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    _make_due(payment)
+
+    poll_due_orders()
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_poll_expires_unpaid_payment(provider, make_payment, merchant):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    TalerOrder.objects.filter(payment=payment).update(
+        pay_deadline=now() - timedelta(minutes=1), next_poll_at=now()
+    )
+
+    poll_due_orders()
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+    assert TalerOrder.objects.get(payment=payment).next_poll_at is None
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_expiry_respects_shard(provider, make_payment, merchant, taler_config):
+    payments = [make_payment(), make_payment()]
+    for p in payments:
+        provider.execute_payment(None, p)
+    TalerOrder.objects.filter(payment__in=payments).update(
+        pay_deadline=now() - timedelta(minutes=1),
+        last_polled_at=now(),
+        next_poll_at=None,
+    )
+    taler_config("shard_count", 2)
+    taler_config("shard_index", payments[0].pk % 2)
+
+    assert expire_payments() == 1
+    for p in payments:
+        p.refresh_from_db()
+    assert payments[0].state == OrderPayment.PAYMENT_STATE_FAILED
+    assert payments[1].state == OrderPayment.PAYMENT_STATE_PENDING
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_refund(provider, make_payment, merchant):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    merchant.pay(payment.full_id)
+    _make_due(payment)
+    poll_due_orders()
+    payment.refresh_from_db()
+
+    refund = payment.order.refunds.create(
+        payment=payment,
+        source=OrderRefund.REFUND_SOURCE_ADMIN,
+        state=OrderRefund.REFUND_STATE_CREATED,
+        amount=payment.amount,
+        provider="taler",
+    )
+    assert provider.payment_refund_supported(payment)
+    provider.execute_refund(refund)
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_TRANSIT
+
+    _make_due(payment)
+    poll_due_orders()
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_DONE
+    # Our own refund must not show up as an additional external refund
+    assert payment.refunds.count() == 1
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_external_refund(provider, make_payment, merchant):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    merchant.pay(payment.full_id)
+    _make_due(payment)
+    poll_due_orders()
+
+    merchant.refund(payment.full_id, "EUR:3.00", "Goodwill")
+    for i in range(2):
+        _make_due(payment)
+        poll_due_orders()
+
+    refunds = list(payment.refunds.all())
+    assert len(refunds) == 1
+    assert refunds[0].source == OrderRefund.REFUND_SOURCE_EXTERNAL
+    assert str(refunds[0].amount) == "3.00"
+    assert TalerOrder.objects.get(payment=payment).refunds_processed == 1
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_failed_refund_processed_by_merchant(provider, make_payment, merchant):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    merchant.pay(payment.full_id)
+    _make_due(payment)
+    poll_due_orders()
+
+    # Our request timed out, but the merchant processed the refund anyway
+    refund = payment.order.refunds.create(
+        payment=payment,
+        source=OrderRefund.REFUND_SOURCE_ADMIN,
+        state=OrderRefund.REFUND_STATE_FAILED,
+        amount=payment.amount,
+        provider="taler",
+    )
+    merchant.refund(payment.full_id, "EUR:23.00", f"{refund.full_id} Refund")
+    _make_due(payment)
+    poll_due_orders()
+
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+    external = payment.refunds.get(source=OrderRefund.REFUND_SOURCE_EXTERNAL)
+    assert str(external.amount) == "23.00"
+    assert TalerOrder.objects.get(payment=payment).refunds_processed == 1
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_webhook(client, event, provider, make_payment, merchant):
+    event.settings.set("payment_taler_webhook_secret", "hook")
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    merchant.pay(payment.full_id)
+
+    url = "/dummy/dummy/_taler/webhook/"
+    body = json.dumps({"order_id": payment.full_id})
+    r = client.post(url, body, content_type="application/json")
+    assert r.status_code == 403
+    r = client.post(
+        url,
+        body,
+        content_type="application/json",
+        HTTP_AUTHORIZATION="Bearer hook",
+    )
+    assert r.status_code == 204
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_status_check_long_polls_without_fast_lane(
+    client, provider, make_payment, merchant, taler_config
+):
+    taler_config("longpoll_timeout", 1)
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    url = provider._payment_url(payment, "return")
+
+    r = client.get(url, {"ajax": 1})
+    assert r.json() == {"refresh": False, "retry": 0}
+    assert merchant.requests[-1][2] == {"timeout_ms": "1000"}
+
+    threading.Timer(0.2, merchant.pay, args=(payment.full_id,)).start()
+    r = client.get(url, {"ajax": 1})
+    assert r.json() == {"refresh": True}
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_status_check_remembers_backend_without_long_polling(
+    client, provider, make_payment, merchant, taler_config
+):
+    taler_config("longpoll_timeout", 2)
+    merchant.longpoll = False
+    get_capabilities(merchant.url)
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    url = provider._payment_url(payment, "return")
+
+    def longpolls():
+        return len([r for r in merchant.requests if "timeout_ms" in r[2]])
+
+    r = client.get(url, {"ajax": 1})
+    assert r.json() == {"refresh": False, "retry": 10000}
+    assert longpolls() == 1
+    assert not supports(merchant.url, "longpoll")
+
+    client.get(url, {"ajax": 1})
+    assert longpolls() == 1
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_status_check_reads_local_state_in_fast_lane(
+    client, provider, make_payment, merchant, fast_lane
+):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    requests = len(merchant.requests)
+
+    r = client.get(provider._payment_url(payment, "return"), {"ajax": 1})
+    assert not r.json()["refresh"]
+    assert len(merchant.requests) == requests
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_qr_code(client, provider, make_payment, merchant):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+
+    url = provider._payment_url(payment, "qr")
+    r = client.get(url)
+    assert r.status_code == 200
+    assert r["Content-Type"] == "image/svg+xml"
+    assert "immutable" in r["Cache-Control"]
+    assert b"<svg" in r.content
+
+    r = client.get(url, HTTP_IF_NONE_MATCH=r["ETag"])
+    assert r.status_code == 304
@@ -0,0 +1,231 @@
+import pytest
+import time
+from datetime import timedelta
+from django.core.cache import cache
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment, OrderRefund
+
+from pretix_taler.models import TalerOrder
+from pretix_taler.polling import (
+    batch_cursor_key,
+    lease_duration,
+    poll_cursor_key,
+    poll_due_orders,
+)
+from pretix_taler.status import invalidate_order_status
+
+
+def test_lease_covers_slow_chunk(taler_config):
+    taler_config("connect_timeout", 5)
+    taler_config("read_timeout", 30)
+    taler_config("rate_limit_wait", 5)
+    taler_config("poll_workers_per_backend", 4)
+    # 50 rounds of requests that all time out
+    assert lease_duration(200) >= timedelta(seconds=50 * 40)
+
+
+def test_lease_minimum(taler_config):
+    taler_config("poll_lease", 300)
+    assert lease_duration(1) == timedelta(seconds=300)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 10, 100])
+def test_lease_grows_with_chunk_size(chunk_size):
+    assert lease_duration(chunk_size * 10) >= lease_duration(chunk_size)
+
+
+def _poll_all(*payments):
+    for p in payments:
+        # As if the status cached when the order was created expired
+        invalidate_order_status(p.payment_provider.settings.merchant_api_url, p.full_id)
+    TalerOrder.objects.filter(payment__in=payments).update(next_poll_at=now())
+    poll_due_orders()
+
+
+def _list_requests(merchant):
+    return [r for r in merchant.requests if r[1] == "private/orders" and r[0] == "GET"]
+
+
+@pytest.fixture
+def batch(taler_config):
+    taler_config("batch_threshold", 2)
+    taler_config("poll_chunk_size", 2)
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_batch_reconciliation_finds_paid_payments(
+    provider, make_payment, merchant, batch
+):
+    payments = [make_payment() for i in range(4)]
+    for p in payments:
+        provider.execute_payment(None, p)
+    merchant.pay(payments[2].full_id)
+    fetched = merchant.count("GET", "private/orders/")
+
+    _poll_all(*payments)
+
+    for p in payments:
+        p.refresh_from_db()
+    assert [p.state for p in payments] == [
+        OrderPayment.PAYMENT_STATE_PENDING,
+        OrderPayment.PAYMENT_STATE_PENDING,
+        OrderPayment.PAYMENT_STATE_CONFIRMED,
+        OrderPayment.PAYMENT_STATE_PENDING,
+    ]
+    # Only the paid order is fetched, and the list is read once for both chunks
+    assert merchant.count("GET", "private/orders/") == fetched + 1
+    assert len(_list_requests(merchant)) == 1
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_batch_reconciliation_resumes_at_cursor(
+    provider, make_payment, merchant, batch
+):
+    merchant.add_order("old-1", "EUR:1.00", paid=True, created=time.time() - 86400)
+    merchant.add_order("old-2", "EUR:1.00", paid=True, created=time.time() - 86400)
+    payments = [make_payment() for i in range(2)]
+    for p in payments:
+        provider.execute_payment(None, p)
+
+    _poll_all(*payments)
+    # The first scan reads backwards and stops at the first order that is too old
+    first = _list_requests(merchant)[-1][2]
+    assert int(first["delta"]) < 0
+    assert cache.get(batch_cursor_key(provider.get_merchant_client())) == (
+        merchant.orders["old-2"]["row_id"]
+    )
+
+    merchant.pay(payments[1].full_id)
+    _poll_all(*payments)
+    second = _list_requests(merchant)[-1][2]
+    assert int(second["delta"]) > 0
+    assert int(second["start"]) == merchant.orders["old-2"]["row_id"]
+    payments[1].refresh_from_db()
+    assert payments[1].state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_batch_reconciliation_skips_confirmed_payments(
+    provider, make_payment, merchant, batch
+):
+    payments = [make_payment() for i in range(2)]
+    for p in payments:
+        provider.execute_payment(None, p)
+        merchant.pay(p.full_id)
+    _poll_all(*payments)
+    merchant.refund(payments[0].full_id, "EUR:1.00", "Goodwill")
+    listed = len(_list_requests(merchant))
+
+    _poll_all(*payments)
+
+    # Confirmed payments are polled one by one, so new refunds are noticed
+    assert len(_list_requests(merchant)) == listed
+    assert (
+        payments[0].refunds.filter(source=OrderRefund.REFUND_SOURCE_EXTERNAL).exists()
+    )
+
+
+@pytest.fixture
+def due_payments(provider, make_payment, merchant, taler_config):
+    taler_config("poll_chunk_size", 2)
+    taler_config("poll_workers", 1)
+    payments = [make_payment() for i in range(5)]
+    for i, p in enumerate(payments):
+        provider.execute_payment(None, p)
+        TalerOrder.objects.filter(payment=p).update(
+            next_poll_at=now() - timedelta(minutes=10 - i)
+        )
+    return payments
+
+
+def _polled(merchant, payments, run):
+    for p in payments:
+        invalidate_order_status(merchant.url, p.full_id)
+    before = len(merchant.requests)
+    run()
+    ids = {f"private/orders/{p.full_id}": p for p in payments}
+    return [ids[r[1]] for r in merchant.requests[before:] if r[1] in ids]
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+@pytest.mark.parametrize("leases", [True, False])
+def test_poll_stops_after_time_budget(due_payments, merchant, taler_config, leases):
+    taler_config("poll_leases", leases)
+    taler_config("poll_time_budget", 0.000001)
+
+    polled = _polled(merchant, due_payments, poll_due_orders)
+
+    # The budget is checked after every chunk
+    assert polled == due_payments[:2]
+    if leases:
+        # Concurrent workers would overwrite each other's position
+        assert cache.get(poll_cursor_key()) is None
+    else:
+        assert cache.get(poll_cursor_key())["pk"] == (
+            TalerOrder.objects.get(payment=due_payments[1]).pk
+        )
+    assert TalerOrder.objects.filter(next_poll_at__lte=now()).count() == 3
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+@pytest.mark.parametrize("leases", [True, False])
+def test_poll_resumes_at_cursor(due_payments, merchant, taler_config, leases):
+    taler_config("poll_leases", leases)
+    taler_config("poll_time_budget", 0.000001)
+    _polled(merchant, due_payments, poll_due_orders)
+    # The first payment became due again and is now the one waiting the longest
+    TalerOrder.objects.filter(payment=due_payments[0]).update(
+        next_poll_at=now() - timedelta(hours=1)
+    )
+
+    taler_config("poll_time_budget", 0)
+    polled = _polled(merchant, due_payments, poll_due_orders)
+
+    if leases:
+        # Without a cursor, the run starts with the payment waiting the longest
+        assert polled == due_payments[:1] + due_payments[2:]
+    else:
+        # Payments after the cursor go first, then the run starts over from the
+        # beginning
+        assert polled == due_payments[2:] + due_payments[:1]
+    assert cache.get(poll_cursor_key()) is None
+    assert not TalerOrder.objects.filter(next_poll_at__lte=now()).exists()
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_poll_ignores_cursor_of_other_ordering(due_payments, merchant, taler_config):
+    taler_config("poll_leases", False)
+    taler_config("poll_time_budget", 0.000001)
+    _polled(merchant, due_payments, poll_due_orders)
+
+    taler_config("poll_time_budget", 0)
+    taler_config("poll_order", "newest")
+    polled = _polled(merchant, due_payments, poll_due_orders)
+
+    assert polled == due_payments[:1:-1]
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_poll_cursor_per_shard(due_payments, merchant, taler_config):
+    taler_config("poll_leases", False)
+    taler_config("poll_time_budget", 0.000001)
+    taler_config("shard_count", 2)
+    taler_config("shard_index", 0)
+    _polled(merchant, due_payments, poll_due_orders)
+    assert cache.get(poll_cursor_key())
+
+    taler_config("shard_index", 1)
+    assert cache.get(poll_cursor_key()) is None
+    taler_config("poll_time_budget", 0)
+    _polled(merchant, due_payments, poll_due_orders)
+    # Shard 1 finishing its run does not touch the position of shard 0
+    taler_config("shard_index", 0)
+    assert cache.get(poll_cursor_key())
@@ -0,0 +1,123 @@
+import pytest
+
+from pretix_taler import ratelimit
+from pretix_taler.client import MerchantClient, MerchantRateLimited
+from pretix_taler.ratelimit import RateLimiter
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def limiter(taler_config, clock):
+    taler_config("rate_limit", 4)
+    taler_config("rate_limit_background_share", 0.5)
+    return RateLimiter("https://backend.test/")
+
+
+def _take(limiter, count, background=False):
+    return [limiter.try_acquire(background) for i in range(count)]
+
+
+def test_disabled(taler_config, clock):
+    taler_config("rate_limit", 0)
+    limiter = RateLimiter("https://backend.test/")
+    assert all(_take(limiter, 100, background=True))
+
+
+def test_interactive_limit(limiter):
+    assert _take(limiter, 5) == [True, True, True, True, False]
+
+
+def test_background_leaves_headroom_for_interactive(limiter):
+    assert _take(limiter, 3, background=True) == [True, True, False]
+    # Interactive requests get what is left of the shared limit, not more
+    assert _take(limiter, 3) == [True, True, False]
+
+
+def test_background_yields_to_interactive(limiter):
+    assert _take(limiter, 2) == [True, True]
+    assert _take(limiter, 1, background=True) == [False]
+    assert _take(limiter, 3) == [True, True, False]
+
+
+def test_background_gets_one_slot_with_small_limit(taler_config, clock):
+    taler_config("rate_limit", 1)
+    limiter = RateLimiter("https://backend.test/")
+    assert _take(limiter, 2, background=True) == [True, False]
+    assert _take(limiter, 1) == [False]
+    clock.now += 1
+    assert _take(limiter, 2) == [True, False]
+
+
+def test_background_share_is_rounded_down(taler_config, clock):
+    taler_config("rate_limit", 5)
+    limiter = RateLimiter("https://backend.test/")
+    assert _take(limiter, 3, background=True) == [True, True, False]
+
+
+def test_rejected_attempts_do_not_use_up_budget(limiter):
+    assert _take(limiter, 2, background=True) == [True, True]
+    assert not any(_take(limiter, 20, background=True))
+    assert _take(limiter, 3) == [True, True, False]
+
+
+def test_new_window(limiter, clock):
+    assert _take(limiter, 5) == [True, True, True, True, False]
+    clock.now += 1
+    assert _take(limiter, 1) == [True]
+
+
+def test_separate_backends(limiter, taler_config):
+    other = RateLimiter("https://other.test/")
+    assert all(_take(limiter, 4))
+    assert all(_take(other, 4))
+
+
+def test_named_limiter_has_own_rate(limiter):
+    refunds = RateLimiter("https://backend.test/", "refunds", 2)
+    assert _take(refunds, 3) == [True, True, False]
+    # The general limit is not affected
+    assert _take(limiter, 5) == [True, True, True, True, False]
+
+
+def test_acquire_waits_for_next_window(limiter, clock):
+    _take(limiter, 4)
+    assert limiter.acquire(timeout=2)
+    assert clock.now >= 1001
+
+
+def test_acquire_gives_up(limiter, clock):
+    _take(limiter, 4)
+    assert not limiter.acquire(timeout=0.5)
+
+
+@pytest.mark.django_db
+def test_client_raises_when_rate_limited(merchant, limiter, taler_config):
+    taler_config("rate_limit_wait", 0)
+    client = MerchantClient(merchant.url, background=True)
+    client.get("config")
+    client.get("config")
+    with pytest.raises(MerchantRateLimited):
+        client.get("config")
+    assert merchant.count("GET", "config") == 2
+    # Checkout traffic still gets through
+    MerchantClient(merchant.url).get("config").raise_for_status()
@@ -0,0 +1,197 @@
+import pytest
+from datetime import timedelta
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderRefund
+
+from pretix_taler import ratelimit, refunds
+from pretix_taler.models import TalerOrder
+from pretix_taler.ratelimit import RateLimiter
+from pretix_taler.refunds import submit_queued_refunds
+
+
+@pytest.fixture
+def queue(provider, taler_config, monkeypatch):
+    provider.settings.set("refund_queue", True)
+    taler_config("refund_workers", 1)
+    taler_config("refund_rate", 0)
+    # No waiting between retries
+    monkeypatch.setattr(refunds.random, "uniform", lambda a, b: 0)
+
+
+def _paid_payment(provider, make_payment, merchant):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    merchant.pay(payment.full_id)
+    payment.confirm()
+    return payment
+
+
+def _queue_refund(provider, payment):
+    refund = payment.order.refunds.create(
+        payment=payment,
+        source=OrderRefund.REFUND_SOURCE_ADMIN,
+        state=OrderRefund.REFUND_STATE_CREATED,
+        amount=payment.amount,
+        provider="taler",
+    )
+    provider.execute_refund(refund)
+    refund.refresh_from_db()
+    assert refund.info_data == {"queued": True}
+    return refund
+
+
+def _refund_posts(merchant):
+    return [
+        r[1].split("/")[2]
+        for r in merchant.requests
+        if r[0] == "POST" and r[1].endswith("/refund")
+    ]
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_refunds_closest_to_deadline_go_first(
+    event, provider, make_payment, merchant, queue
+):
+    later = _paid_payment(provider, make_payment, merchant)
+    sooner = _paid_payment(provider, make_payment, merchant)
+    TalerOrder.objects.filter(payment=later).update(
+        refund_deadline=now() + timedelta(days=2)
+    )
+    TalerOrder.objects.filter(payment=sooner).update(
+        refund_deadline=now() + timedelta(days=1)
+    )
+    r1 = _queue_refund(provider, later)
+    r2 = _queue_refund(provider, sooner)
+
+    submit_queued_refunds(event)
+
+    assert _refund_posts(merchant) == [sooner.full_id, later.full_id]
+    for r in (r1, r2):
+        r.refresh_from_db()
+        assert r.state == OrderRefund.REFUND_STATE_TRANSIT
+        assert "taler_refund_uri" in r.info_data
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_refund_is_retried(event, provider, make_payment, merchant, queue):
+    payment = _paid_payment(provider, make_payment, merchant)
+    refund = _queue_refund(provider, payment)
+    merchant.fail_next(1)
+
+    submit_queued_refunds(event)
+
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_TRANSIT
+    assert "taler_refund_uri" in refund.info_data
+    assert _refund_posts(merchant) == [payment.full_id, payment.full_id]
+    assert len(merchant.orders[payment.full_id]["refunds"]) == 1
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_refund_fails_after_last_attempt(
+    event, provider, make_payment, merchant, queue, taler_config
+):
+    taler_config("refund_attempts", 2)
+    payment = _paid_payment(provider, make_payment, merchant)
+    refund = _queue_refund(provider, payment)
+    merchant.fail_next(2)
+
+    submit_queued_refunds(event)
+
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+    assert refund.info_data["error"]
+    assert not merchant.orders[payment.full_id]["refunds"]
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_interrupted_run_does_not_refund_twice(
+    event, provider, make_payment, merchant, queue
+):
+    submitted = _paid_payment(provider, make_payment, merchant)
+    lost = _paid_payment(provider, make_payment, merchant)
+    r1 = _queue_refund(provider, submitted)
+    r2 = _queue_refund(provider, lost)
+    # A previous run marked both refunds and got the first one to the merchant before
+    # it was interrupted
+    for r in (r1, r2):
+        r.info_data = {"queued": True, "submitting": True}
+        r.save(update_fields=["info"])
+    merchant.refund(submitted.full_id, "EUR:23.00", f"{r1.full_id} Refund")
+
+    submit_queued_refunds(event)
+
+    assert _refund_posts(merchant) == [lost.full_id]
+    assert len(merchant.orders[submitted.full_id]["refunds"]) == 1
+    assert len(merchant.orders[lost.full_id]["refunds"]) == 1
+    for r in (r1, r2):
+        r.refresh_from_db()
+        assert r.state == OrderRefund.REFUND_STATE_TRANSIT
+        assert not r.info_data.get("queued")
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_refund_after_deadline_fails(event, provider, make_payment, merchant, queue):
+    payment = _paid_payment(provider, make_payment, merchant)
+    TalerOrder.objects.filter(payment=payment).update(
+        refund_deadline=now() - timedelta(minutes=1)
+    )
+    refund = _queue_refund(provider, payment)
+
+    submit_queued_refunds(event)
+
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+    assert refund.info_data["message"] == "The refund deadline has passed."
+    assert not _refund_posts(merchant)
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_progress_is_shown_in_settings(event, provider, make_payment, merchant, queue):
+    assert provider.settings_content_render(None) == ""
+    payment = _paid_payment(provider, make_payment, merchant)
+    _queue_refund(provider, payment)
+
+    submit_queued_refunds(event)
+
+    assert "submitted 1 of 1 Taler refunds, 0 failed" in (
+        provider.settings_content_render(None)
+    )
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_refund_rate_is_shared_per_backend(
+    event, provider, make_payment, merchant, queue, taler_config, monkeypatch
+):
+    class Clock:
+        now = 1000.0
+
+        def time(self):
+            return self.now
+
+        monotonic = time
+
+        def sleep(self, seconds):
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    taler_config("refund_rate", 1)
+    payment = _paid_payment(provider, make_payment, merchant)
+    refund = _queue_refund(provider, payment)
+    # Another event on the same backend used up this second's refund
+    assert RateLimiter(merchant.url, "refunds", 1).try_acquire()
+
+    submit_queued_refunds(event)
+
+    assert clock.now >= 1001
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_TRANSIT
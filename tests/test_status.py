@@ -0,0 +1,141 @@
+import pytest
+import threading
+import time
+from django.core.cache import cache
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderRefund
+
+from pretix_taler import status
+from pretix_taler.status import (
+    STATUS_CACHE_TTL,
+    STATUS_CACHE_TTL_FINAL,
+    cached_order_status,
+    order_status_cache_key,
+)
+
+URL = "https://backend.test/"
+
+
+class RecordingCache:
+    def __init__(self):
+        self.timeouts = {}
+
+    def set(self, key, value, timeout):
+        self.timeouts[key] = timeout
+        cache.set(key, value, timeout)
+
+    def __getattr__(self, name):
+        return getattr(cache, name)
+
+
+def _fetch(resp, delay=0):
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(delay)
+        return resp
+
+    return fetch, calls
+
+
+def test_cached():
+    fetch, calls = _fetch({"order_status": "unpaid"})
+    assert cached_order_status(URL, "1", fetch) == {"order_status": "unpaid"}
+    assert cached_order_status(URL, "1", fetch) == {"order_status": "unpaid"}
+    assert len(calls) == 1
+
+
+def test_bypass_cache():
+    fetch, calls = _fetch({"order_status": "unpaid"})
+    cached_order_status(URL, "1", fetch, use_cache=False)
+    cached_order_status(URL, "1", fetch, use_cache=False)
+    assert len(calls) == 2
+    # The response is still shared with others
+    cached_order_status(URL, "1", fetch)
+    assert len(calls) == 2
+
+
+def test_single_flight():
+    fetch, calls = _fetch({"order_status": "paid"}, delay=0.3)
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cached_order_status(URL, "1", fetch))
+        )
+        for i in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [{"order_status": "paid"}] * 5
+
+
+@pytest.mark.parametrize(
+    "resp,ttl",
+    [
+        ({"order_status": "unpaid"}, STATUS_CACHE_TTL),
+        (
+            {
+                "order_status": "unpaid",
+                "contract_terms": {"pay_deadline": {"t_s": int(time.time()) + 60}},
+            },
+            STATUS_CACHE_TTL,
+        ),
+        (
+            {
+                "order_status": "unpaid",
+                "contract_terms": {"pay_deadline": {"t_s": int(time.time()) - 60}},
+            },
+            STATUS_CACHE_TTL_FINAL,
+        ),
+        (
+            {
+                "order_status": "paid",
+                "contract_terms": {
+                    "pay_deadline": {"t_s": int(time.time()) - 60},
+                    "refund_deadline": {"t_s": int(time.time()) + 60},
+                },
+            },
+            STATUS_CACHE_TTL,
+        ),
+        (
+            {
+                "order_status": "paid",
+                "contract_terms": {"refund_deadline": {"t_s": int(time.time()) - 60}},
+            },
+            STATUS_CACHE_TTL_FINAL,
+        ),
+    ],
+)
+def test_ttl(monkeypatch, resp, ttl):
+    recording = RecordingCache()
+    monkeypatch.setattr(status, "cache", recording)
+    fetch, calls = _fetch(resp)
+    cached_order_status(URL, "1", fetch)
+    assert recording.timeouts[order_status_cache_key(URL, "1")] == ttl
+
+
+@pytest.mark.django_db
+@scopes_disabled()
+def test_invalidated_after_refund(provider, make_payment, merchant):
+    payment = make_payment()
+    provider.execute_payment(None, payment)
+    merchant.pay(payment.full_id)
+    payment.confirm()
+    key = order_status_cache_key(merchant.url, payment.full_id)
+    assert cache.get(key) is not None
+
+    refund = payment.order.refunds.create(
+        payment=payment,
+        source=OrderRefund.REFUND_SOURCE_ADMIN,
+        state=OrderRefund.REFUND_STATE_CREATED,
+        amount=payment.amount,
+        provider="taler",
+    )
+    provider.execute_refund(refund)
+
+    assert cache.get(key) is None